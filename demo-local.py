@@ -6,9 +6,13 @@
 """
 
 import requests
-import json
 import time
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 def test_api():
     """Тестирование API"""
     base_url = "http://localhost:8000"
@@ -21,7 +25,7 @@ def test_api():
     try:
         response = requests.get(f"{base_url}/health")
         if response.status_code == 200:
-            data = response.json()
+            data = json_loads(response.content)
             print(f"✅ Сервис здоров: {data['service']} v{data['version']}")
         else:
             print(f"❌ Ошибка: {response.status_code}")
@@ -35,7 +39,7 @@ def test_api():
     try:
         response = requests.get(f"{base_url}/status")
         if response.status_code == 200:
-            data = response.json()
+            data = json_loads(response.content)
             print(f"✅ Статус: {data['status']}")
             print(f"   Активных соединений: {data['active_connections']}")
             print(f"   Всего сообщений: {data['total_messages']}")
@@ -62,7 +66,7 @@ def test_api():
                 json={"text": message, "user_id": "demo_user"}
             )
             if response.status_code == 200:
-                data = response.json()
+                data = json_loads(response.content)
                 print(f"   ✅ Ответ: {data['data']['response']}")
             else:
                 print(f"   ❌ Ошибка: {response.status_code}")
@@ -76,7 +80,7 @@ def test_api():
     try:
         response = requests.get(f"{base_url}/messages")
         if response.status_code == 200:
-            data = response.json()
+            data = json_loads(response.content)
             print(f"✅ Получено {len(data['messages'])} сообщений")
             for msg in data['messages'][-3:]:  # Последние 3 сообщения
                 print(f"   - {msg['text']} (от {msg['user_id']})")
@@ -5,23 +5,40 @@
 Версия: 1.0.0
 """
 
-import requests
-import json
-import time
-import subprocess
+import asyncio
+import importlib.util
+import httpx
+import socket
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 def get_real_ip():
     """Получение реального IP адреса"""
     try:
-        result = subprocess.run(['hostname', '-I'], capture_output=True, text=True)
-        if result.returncode == 0:
-            ips = result.stdout.strip().split()
-            return ips[0] if ips else "localhost"
-    except:
-        pass
-    return "localhost"
+        # UDP connect не отправляет пакетов, а лишь выбирает исходящий интерфейс
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except OSError:
+        return "localhost"
+
+async def send_message(client, message):
+    """Отправка сообщения; при ответе 429 ждем столько, сколько указал сервер"""
+    payload = {"text": message, "user_id": "demo_user"}
+    response = await client.post("/message", json=payload)
+    if response.status_code == 429:
+        try:
+            retry_after = float(response.headers.get("Retry-After", "1"))
+        except ValueError:
+            retry_after = 1.0
+        await asyncio.sleep(retry_after)
+        response = await client.post("/message", json=payload)
+    return response
 
-def test_api():
+async def test_api():
     """Тестирование API"""
     real_ip = get_real_ip()
     base_url = f"http://{real_ip}:8000"
@@ -32,75 +49,81 @@ def test_api():
     print(f"🔗 URL: {base_url}")
     print("=" * 60)
     
-    # Проверка здоровья
-    print("1. Проверка здоровья сервиса...")
-    try:
-        response = requests.get(f"{base_url}/health")
-        if response.status_code == 200:
-            data = response.json()
-            print(f"✅ Сервис здоров: {data['service']} v{data['version']}")
-        else:
-            print(f"❌ Ошибка: {response.status_code}")
+    # HTTP/2 (через ALPN для https) позволяет мультиплексировать запросы в одном соединении
+    async with httpx.AsyncClient(
+        base_url=base_url,
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+        timeout=10.0
+    ) as client:
+        # Проверка здоровья
+        print("1. Проверка здоровья сервиса...")
+        try:
+            response = await client.get("/health")
+            if response.status_code == 200:
+                data = json_loads(response.content)
+                print(f"✅ Сервис здоров: {data['service']} v{data['version']}")
+            else:
+                print(f"❌ Ошибка: {response.status_code}")
+                return
+        except Exception as e:
+            print(f"❌ Ошибка подключения: {e}")
             return
-    except Exception as e:
-        print(f"❌ Ошибка подключения: {e}")
-        return
-    
-    # Проверка статуса
-    print("\n2. Получение статуса...")
-    try:
-        response = requests.get(f"{base_url}/status")
-        if response.status_code == 200:
-            data = response.json()
-            print(f"✅ Статус: {data['status']}")
-            print(f"   Активных соединений: {data['active_connections']}")
-            print(f"   Всего сообщений: {data['total_messages']}")
-        else:
-            print(f"❌ Ошибка: {response.status_code}")
-    except Exception as e:
-        print(f"❌ Ошибка: {e}")
-    
-    # Тестирование сообщений
-    print("\n3. Тестирование сообщений...")
-    test_messages = [
-        "Привет, Jarvis!",
-        "Как дела?",
-        "Который час?",
-        "Что ты умеешь?",
-        "Спасибо за помощь!"
-    ]
-    
-    for i, message in enumerate(test_messages, 1):
-        print(f"\n   Тест {i}: {message}")
+        
+        # Проверка статуса
+        print("\n2. Получение статуса...")
         try:
-            response = requests.post(
-                f"{base_url}/message",
-                json={"text": message, "user_id": "demo_user"}
-            )
+            response = await client.get("/status")
             if response.status_code == 200:
-                data = response.json()
+                data = json_loads(response.content)
+                print(f"✅ Статус: {data['status']}")
+                print(f"   Активных соединений: {data['active_connections']}")
+                print(f"   Всего сообщений: {data['total_messages']}")
+            else:
+                print(f"❌ Ошибка: {response.status_code}")
+        except Exception as e:
+            print(f"❌ Ошибка: {e}")
+        
+        # Тестирование сообщений
+        print("\n3. Тестирование сообщений...")
+        test_messages = [
+            "Привет, Jarvis!",
+            "Как дела?",
+            "Который час?",
+            "Что ты умеешь?",
+            "Спасибо за помощь!"
+        ]
+        
+        # Все сообщения отправляются параллельно по общему пулу соединений
+        responses = await asyncio.gather(
+            *[send_message(client, message) for message in test_messages],
+            return_exceptions=True
+        )
+        
+        for i, (message, response) in enumerate(zip(test_messages, responses), 1):
+            print(f"\n   Тест {i}: {message}")
+            if isinstance(response, Exception):
+                print(f"   ❌ Ошибка: {response}")
+            elif response.status_code == 200:
+                data = json_loads(response.content)
                 print(f"   ✅ Ответ: {data['data']['response']}")
             else:
                 print(f"   ❌ Ошибка: {response.status_code}")
+        
+        # Получение всех сообщений
+        print("\n4. Получение истории сообщений...")
+        try:
+            response = await client.get("/messages")
+            if response.status_code == 200:
+                data = json_loads(response.content)
+                print(f"✅ Получено {len(data['messages'])} сообщений")
+                for msg in data['messages'][-3:]:  # Последние 3 сообщения
+                    print(f"   - {msg['text']} (от {msg['user_id']})")
+            else:
+                print(f"❌ Ошибка: {response.status_code}")
         except Exception as e:
-            print(f"   ❌ Ошибка: {e}")
+            print(f"❌ Ошибка: {e}")
         
-        time.sleep(1)  # Пауза между сообщениями
-    
-    # Получение всех сообщений
-    print("\n4. Получение истории сообщений...")
-    try:
-        response = requests.get(f"{base_url}/messages")
-        if response.status_code == 200:
-            data = response.json()
-            print(f"✅ Получено {len(data['messages'])} сообщений")
-            for msg in data['messages'][-3:]:  # Последние 3 сообщения
-                print(f"   - {msg['text']} (от {msg['user_id']})")
-        else:
-            print(f"❌ Ошибка: {response.status_code}")
-    except Exception as e:
-        print(f"❌ Ошибка: {e}")
-    
     print("\n" + "=" * 60)
     print("🎉 Демонстрация завершена!")
     print(f"🌐 Веб-интерфейс: http://{real_ip}:8000")
@@ -109,4 +132,4 @@ def test_api():
     print("=" * 60)
 
 if __name__ == "__main__":
-    test_api()
\ No newline at end of file
+    asyncio.run(test_api())
\ No newline at end of file
@@ -6,9 +6,15 @@ import os
 import sys
 import subprocess
 import asyncio
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import logging
 
+# Многопоточная загрузка с HuggingFace Hub (должна быть включена до импорта huggingface_hub)
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -40,6 +46,13 @@ def check_dependencies():
     
     return True
 
+def snapshot_model(repo_id: str) -> str:
+    """Загрузка файлов модели с HuggingFace Hub в shared/models (параллельно, с проверкой)"""
+    from huggingface_hub import snapshot_download
+    
+    local_dir = Path("shared/models") / repo_id.split("/")[-1]
+    return snapshot_download(repo_id=repo_id, local_dir=str(local_dir), max_workers=8)
+
 def download_whisper_model():
     """Загрузка модели Whisper"""
     logger.info("Загрузка модели Whisper...")
@@ -48,14 +61,17 @@ def download_whisper_model():
         model = whisper.load_model("base")
         logger.info("✓ Whisper модель 'base' загружена")
         
-        # Проверка доступности других размеров
+        # Проверка доступности других размеров без загрузки весов (HEAD запрос)
+        import requests
         sizes = ["tiny", "small", "medium", "large"]
-        for size in sizes:
-            try:
-                whisper.load_model(size)
-                logger.info(f"✓ Whisper модель '{size}' доступна")
-            except Exception as e:
-                logger.warning(f"✗ Whisper модель '{size}' недоступна: {e}")
+        with requests.Session() as session:
+            for size in sizes:
+                try:
+                    response = session.head(whisper._MODELS[size], allow_redirects=True, timeout=5)
+                    response.raise_for_status()
+                    logger.info(f"✓ Whisper модель '{size}' доступна")
+                except Exception as e:
+                    logger.warning(f"✗ Whisper модель '{size}' недоступна: {e}")
         
         return True
     except Exception as e:
@@ -91,7 +107,8 @@ def download_embedding_model():
     try:
         from sentence_transformers import SentenceTransformer
         
-        model = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+        model_path = snapshot_model('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+        model = SentenceTransformer(model_path)
         logger.info("✓ Модель эмбеддингов 'paraphrase-multilingual-MiniLM-L12-v2' загружена")
         
         # Тест модели
@@ -108,22 +125,27 @@ def download_phi2_model():
     """Загрузка модели Phi-2"""
     logger.info("Загрузка модели Phi-2...")
     try:
+        import torch
         from transformers import AutoTokenizer, AutoModelForCausalLM
         
-        model_name = "microsoft/phi-2"
-        tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+        model_path = snapshot_model("microsoft/phi-2")
+        # Половинная точность: fp16 на GPU, bf16 на CPU
+        dtype = torch.float16 if torch.cuda.is_available() else torch.bfloat16
+        tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, local_files_only=True)
         model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype="auto",
-            trust_remote_code=True
+            model_path,
+            torch_dtype=dtype,
+            trust_remote_code=True,
+            local_files_only=True,
+            device_map="auto"
         )
         
         logger.info("✓ Модель Phi-2 загружена")
         
         # Тест модели
         test_prompt = "Привет! Как дела?"
-        inputs = tokenizer(test_prompt, return_tensors="pt")
-        with torch.no_grad():
+        inputs = tokenizer(test_prompt, return_tensors="pt").to(model.device)
+        with torch.inference_mode():
             outputs = model.generate(**inputs, max_length=50, do_sample=True)
         response = tokenizer.decode(outputs[0], skip_special_tokens=True)
         logger.info(f"✓ Тест Phi-2 прошел успешно")
@@ -139,9 +161,10 @@ def download_classification_model():
     try:
         from transformers import pipeline
         
+        model_path = snapshot_model("cointegrated/rubert-tiny2-cedr-emotion-detection")
         classifier = pipeline(
             "text-classification",
-            model="cointegrated/rubert-tiny2-cedr-emotion-detection"
+            model=model_path
         )
         
         logger.info("✓ Модель классификации 'rubert-tiny2' загружена")
@@ -193,9 +216,14 @@ def create_model_info():
         }
     }
     
-    import json
-    with open("shared/models/model_info.json", "w", encoding="utf-8") as f:
-        json.dump(model_info, f, ensure_ascii=False, indent=2)
+    model_info_path = Path("shared/models/model_info.json")
+    try:
+        import orjson
+        model_info_path.write_bytes(orjson.dumps(model_info, option=orjson.OPT_INDENT_2))
+    except ImportError:
+        import json
+        with open(model_info_path, "w", encoding="utf-8") as f:
+            json.dump(model_info, f, ensure_ascii=False, indent=2)
     
     logger.info("✓ Файл информации о моделях создан")
 
@@ -238,23 +266,19 @@ def main():
     os.makedirs("shared/models", exist_ok=True)
     
     # Загрузка моделей
-    success_count = 0
-    total_models = 5
-    
-    if download_whisper_model():
-        success_count += 1
-    
-    if download_tts_model():
-        success_count += 1
-    
-    if download_embedding_model():
-        success_count += 1
-    
-    if download_phi2_model():
-        success_count += 1
+    downloaders = [
+        download_whisper_model,
+        download_tts_model,
+        download_embedding_model,
+        download_phi2_model,
+        download_classification_model
+    ]
+    total_models = len(downloaders)
     
-    if download_classification_model():
-        success_count += 1
+    # Загрузки не зависят друг от друга и ограничены сетью - выполняем параллельно
+    with ThreadPoolExecutor(max_workers=total_models) as executor:
+        futures = [executor.submit(downloader) for downloader in downloaders]
+        success_count = sum(1 for future in as_completed(futures) if future.result())
     
     # Создание информации о моделях
     create_model_info()
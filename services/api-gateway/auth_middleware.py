@@ -3,9 +3,18 @@ Middleware аутентификации для API Gateway
 Обработка JWT токенов и аутентификации пользователей
 """
 import jwt
+import asyncio
+import os
 import time
-from typing import Dict, Optional, Any
-from datetime import datetime, timedelta
+import base64
+import hashlib
+import hmac
+import re
+import orjson
+from typing import Dict, Optional, Any, Tuple
+from collections import OrderedDict
+from datetime import timedelta
+from functools import lru_cache
 import logging
 from passlib.context import CryptContext
 from dataclasses import dataclass
@@ -14,12 +23,50 @@ from utils.logger import get_logger
 
 logger = get_logger("auth-middleware")
 
-@dataclass
+_pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Встроенные пользователи (в реальном приложении - база данных).
+# Готовый bcrypt хеш можно передать через переменную окружения из "hash_env".
+_SEED_USERS = {
+    "admin": {
+        "password": "admin123",
+        "hash_env": "JARVIS_ADMIN_HASH",
+        "role": "admin",
+        "permissions": ["read", "write", "admin"]
+    },
+    "user": {
+        "password": "user123",
+        "hash_env": "JARVIS_USER_HASH",
+        "role": "user",
+        "permissions": ["read"]
+    }
+}
+
+# Сегмент JWT: только алфавит base64url без выравнивания
+_B64URL_SEGMENT_RE = re.compile(rb"[A-Za-z0-9_-]*")
+
+def _b64url_decode(segment: bytes) -> bytes:
+    """Строгое декодирование сегмента JWT (посторонние символы не отбрасываются)"""
+    if not _B64URL_SEGMENT_RE.fullmatch(segment) or len(segment) % 4 == 1:
+        raise ValueError("Invalid base64url segment")
+    return base64.b64decode(segment + b"=" * (-len(segment) % 4), altchars=b"-_", validate=True)
+
+@lru_cache(maxsize=256)
+def _permission_set(permissions: tuple) -> frozenset:
+    """Множество разрешений для проверки (одно на каждый набор разрешений)"""
+    return frozenset(permissions)
+
+@lru_cache(maxsize=None)
+def _seed_hash(password: str) -> str:
+    """Хеш пароля встроенного пользователя (вычисляется один раз на процесс)"""
+    return _pwd_context.hash(password)
+
+@dataclass(slots=True, frozen=True)
 class SecurityConfig:
     """Конфигурация безопасности"""
     secret_key: str
     jwt_expire_hours: int
-    allowed_origins: list
+    allowed_origins: tuple
     rate_limit_per_minute: int
 
 class AuthMiddleware:
@@ -27,30 +74,97 @@ class AuthMiddleware:
     
     def __init__(self, security_config: SecurityConfig):
         self.config = security_config
-        self.pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+        self.pwd_context = _pwd_context
         self.algorithm = "HS256"
+        self._exp_seconds = security_config.jwt_expire_hours * 3600
+        self._secret_key = security_config.secret_key
+        self._secret_bytes = security_config.secret_key.encode()
         
         # Временное хранилище пользователей (в реальном приложении - база данных)
         self.users = {
-            "admin": {
-                "username": "admin",
-                "password_hash": self.pwd_context.hash("admin123"),
-                "role": "admin",
-                "permissions": ["read", "write", "admin"]
-            },
-            "user": {
-                "username": "user",
-                "password_hash": self.pwd_context.hash("user123"),
-                "role": "user",
-                "permissions": ["read"]
+            username: {
+                "username": username,
+                "password_hash": os.getenv(seed["hash_env"]) or _seed_hash(seed["password"]),
+                "role": seed["role"],
+                "permissions": list(seed["permissions"])
             }
+            for username, seed in _SEED_USERS.items()
         }
+        for user in self.users.values():
+            self._refresh_public_view(user)
+        self._admin_count = sum(1 for user in self.users.values() if user["role"] == "admin")
+        
+        # Кэш результатов проверки паролей: ключ связывает пароль и хранимый хеш.
+        # Дайджест ключуется секретом процесса: вне процесса по нему нельзя перебирать пароли
+        self._verify_key = os.urandom(32)
+        self._verify_cache: Dict[bytes, Tuple[bool, float]] = {}
+        self.verify_cache_size = 1024
+        self.verify_cache_ttl = 60  # секунды
+        
+        # LRU кэш проверенных токенов: digest токена -> (payload, exp)
+        self._token_cache: "OrderedDict[bytes, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self.token_cache_size = 4096
+        
+        # Предварительно связанные ссылки для горячего пути authenticate_request
+        self._users_get = self.users.get
+        self._verify_token = self.verify_token
+        self._token_cache_get = self._token_cache.get
         
         logger.info("Auth middleware initialized")
     
+    def _refresh_public_view(self, user: Dict[str, Any]):
+        """Обновление публичного представления пользователя
+        
+        Разрешения в нем - кортеж: по нему check_permission берет готовое множество.
+        """
+        user["public"] = {
+            "username": user["username"],
+            "role": user["role"],
+            "permissions": tuple(user["permissions"])
+        }
+    
     def verify_password(self, plain_password: str, hashed_password: str) -> bool:
         """Проверка пароля"""
-        return self.pwd_context.verify(plain_password, hashed_password)
+        key = self._verify_cache_key(plain_password, hashed_password)
+        result = self._get_cached_verification(key)
+        if result is None:
+            result = self.pwd_context.verify(plain_password, hashed_password)
+            self._cache_verification(key, result)
+        return result
+    
+    async def verify_password_async(self, plain_password: str, hashed_password: str) -> bool:
+        """Проверка пароля без блокировки event loop
+        
+        Кэш читается и обновляется в event loop; в пул потоков уходит только bcrypt.
+        """
+        key = self._verify_cache_key(plain_password, hashed_password)
+        result = self._get_cached_verification(key)
+        if result is None:
+            result = await asyncio.to_thread(self.pwd_context.verify, plain_password, hashed_password)
+            self._cache_verification(key, result)
+        return result
+    
+    def _verify_cache_key(self, plain_password: str, hashed_password: str) -> bytes:
+        """Ключ кэша проверки пароля"""
+        return hashlib.blake2b(
+            plain_password.encode() + b"|" + hashed_password.encode(),
+            key=self._verify_key,
+            digest_size=16
+        ).digest()
+    
+    def _get_cached_verification(self, key: bytes) -> Optional[bool]:
+        """Результат проверки пароля из кэша, если он не устарел"""
+        cached = self._verify_cache.get(key)
+        if cached is not None and time.monotonic() - cached[1] < self.verify_cache_ttl:
+            return cached[0]
+        return None
+    
+    def _cache_verification(self, key: bytes, result: bool):
+        """Сохранение результата проверки пароля в кэш"""
+        # Вытеснение самой старой записи при переполнении
+        if key not in self._verify_cache and len(self._verify_cache) >= self.verify_cache_size:
+            self._verify_cache.pop(next(iter(self._verify_cache)), None)
+        self._verify_cache[key] = (result, time.monotonic())
     
     def get_password_hash(self, password: str) -> str:
         """Хеширование пароля"""
@@ -60,25 +174,50 @@ class AuthMiddleware:
         """Создание JWT токена"""
         to_encode = data.copy()
         
+        now = int(time.time())
         if expires_delta:
-            expire = datetime.utcnow() + expires_delta
+            expire = now + int(expires_delta.total_seconds())
         else:
-            expire = datetime.utcnow() + timedelta(hours=self.config.jwt_expire_hours)
+            expire = now + self._exp_seconds
         
-        to_encode.update({"exp": expire, "iat": datetime.utcnow()})
+        to_encode.update({"exp": expire, "iat": now})
         
-        encoded_jwt = jwt.encode(to_encode, self.config.secret_key, algorithm=self.algorithm)
+        encoded_jwt = jwt.encode(to_encode, self._secret_key, algorithm=self.algorithm)
         return encoded_jwt
     
     def verify_token(self, token: str) -> Optional[Dict[str, Any]]:
-        """Проверка JWT токена"""
+        """Проверка JWT токена (HS256)"""
         try:
-            payload = jwt.decode(token, self.config.secret_key, algorithms=[self.algorithm])
+            segments = token.encode().split(b".")
+            if len(segments) != 3:
+                logger.warning("JWT error: Not enough or too many segments")
+                return None
+            header_b64, payload_b64, signature_b64 = segments
+            
+            # Проверка подписи до разбора содержимого
+            signature = _b64url_decode(signature_b64)
+            expected = hmac.new(self._secret_bytes, header_b64 + b"." + payload_b64, hashlib.sha256).digest()
+            if not hmac.compare_digest(signature, expected):
+                logger.warning("JWT error: Signature verification failed")
+                return None
+            
+            header = orjson.loads(_b64url_decode(header_b64))
+            if header.get("alg") != self.algorithm:
+                logger.warning(f"JWT error: Unexpected algorithm {header.get('alg')}")
+                return None
+            
+            payload = orjson.loads(_b64url_decode(payload_b64))
+            if not isinstance(payload, dict):
+                logger.warning("JWT error: Invalid payload")
+                return None
+            
+            exp = payload.get("exp")
+            if exp is not None and time.time() >= exp:
+                logger.warning("Token has expired")
+                return None
+            
             return payload
-        except jwt.ExpiredSignatureError:
-            logger.warning("Token has expired")
-            return None
-        except jwt.JWTError as e:
+        except (ValueError, TypeError, AttributeError) as e:
             logger.warning(f"JWT error: {e}")
             return None
     
@@ -90,7 +229,8 @@ class AuthMiddleware:
             
             user = self.users[username]
             
-            if not self.verify_password(password, user["password_hash"]):
+            # bcrypt выполняется в пуле потоков, чтобы не блокировать event loop
+            if not await self.verify_password_async(password, user["password_hash"]):
                 return {"success": False, "error": "Invalid username or password"}
             
             # Создание токена
@@ -103,17 +243,39 @@ class AuthMiddleware:
             return {
                 "success": True,
                 "access_token": access_token,
-                "user": {
-                    "username": username,
-                    "role": user["role"],
-                    "permissions": user["permissions"]
-                }
+                "user": user["public"]
             }
             
         except Exception as e:
             logger.error(f"Authentication error: {e}")
             return {"success": False, "error": "Authentication failed"}
     
+    def _get_cached_token(self, token: str) -> Optional[Dict[str, Any]]:
+        """Получение payload ранее проверенного токена"""
+        key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        cached = self._token_cache_get(key)
+        if cached is None:
+            return None
+        
+        payload, expire = cached
+        if time.time() >= expire:
+            del self._token_cache[key]
+            return None
+        
+        self._token_cache.move_to_end(key)
+        return payload
+    
+    def _cache_token(self, token: str, payload: Dict[str, Any]):
+        """Сохранение проверенного токена в кэш"""
+        expire = payload.get("exp")
+        if expire is None:
+            return
+        
+        key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        self._token_cache[key] = (payload, expire)
+        if len(self._token_cache) > self.token_cache_size:
+            self._token_cache.popitem(last=False)
+    
     async def authenticate_request(self, request) -> Dict[str, Any]:
         """Аутентификация HTTP запроса"""
         try:
@@ -129,25 +291,23 @@ class AuthMiddleware:
             
             token = authorization.split(" ")[1]
             
-            # Проверка токена
-            payload = self.verify_token(token)
-            if not payload:
-                return {"authenticated": False, "error": "Invalid or expired token"}
+            # Проверка токена (повторные запросы с тем же токеном берутся из кэша)
+            payload = self._get_cached_token(token)
+            if payload is None:
+                payload = self._verify_token(token)
+                if not payload:
+                    return {"authenticated": False, "error": "Invalid or expired token"}
+                self._cache_token(token, payload)
             
             # Получение информации о пользователе
             username = payload.get("sub")
-            if not username or username not in self.users:
+            user = self._users_get(username) if username else None
+            if user is None:
                 return {"authenticated": False, "error": "User not found"}
             
-            user = self.users[username]
-            
             return {
                 "authenticated": True,
-                "user": {
-                    "username": username,
-                    "role": user["role"],
-                    "permissions": user["permissions"]
-                },
+                "user": user["public"],
                 "payload": payload
             }
             
@@ -190,24 +350,19 @@ class AuthMiddleware:
             return {"success": False, "error": "Token refresh failed"}
     
     def check_permission(self, user: Dict[str, Any], required_permission: str) -> bool:
-        """Проверка разрешения пользователя"""
-        try:
-            user_permissions = user.get("permissions", [])
-            return required_permission in user_permissions or "admin" in user_permissions
-            
-        except Exception as e:
-            logger.error(f"Permission check error: {e}")
-            return False
+        """Проверка разрешения пользователя
+        
+        Учитываются только разрешения переданного представления пользователя.
+        """
+        user_permissions = user.get("permissions", ())
+        if isinstance(user_permissions, tuple):
+            user_permissions = _permission_set(user_permissions)
+        return required_permission in user_permissions or "admin" in user_permissions
     
     def check_role(self, user: Dict[str, Any], required_role: str) -> bool:
         """Проверка роли пользователя"""
-        try:
-            user_role = user.get("role")
-            return user_role == required_role or user_role == "admin"
-            
-        except Exception as e:
-            logger.error(f"Role check error: {e}")
-            return False
+        user_role = user.get("role")
+        return user_role == required_role or user_role == "admin"
     
     async def create_user(self, username: str, password: str, role: str = "user", permissions: list = None) -> Dict[str, Any]:
         """Создание нового пользователя"""
@@ -218,24 +373,24 @@ class AuthMiddleware:
             if permissions is None:
                 permissions = ["read"] if role == "user" else ["read", "write"]
             
-            password_hash = self.get_password_hash(password)
+            password_hash = await asyncio.to_thread(self.get_password_hash, password)
             
-            self.users[username] = {
+            user = {
                 "username": username,
                 "password_hash": password_hash,
                 "role": role,
                 "permissions": permissions
             }
+            self._refresh_public_view(user)
+            self.users[username] = user
+            if role == "admin":
+                self._admin_count += 1
             
             logger.info(f"User created: {username} with role: {role}")
             
             return {
                 "success": True,
-                "user": {
-                    "username": username,
-                    "role": role,
-                    "permissions": permissions
-                }
+                "user": user["public"]
             }
             
         except Exception as e:
@@ -252,23 +407,23 @@ class AuthMiddleware:
             
             # Обновление полей
             if "password" in kwargs:
-                user["password_hash"] = self.get_password_hash(kwargs["password"])
+                user["password_hash"] = await asyncio.to_thread(self.get_password_hash, kwargs["password"])
             
             if "role" in kwargs:
+                self._admin_count += (kwargs["role"] == "admin") - (user["role"] == "admin")
                 user["role"] = kwargs["role"]
             
             if "permissions" in kwargs:
                 user["permissions"] = kwargs["permissions"]
             
+            if "role" in kwargs or "permissions" in kwargs:
+                self._refresh_public_view(user)
+            
             logger.info(f"User updated: {username}")
             
             return {
                 "success": True,
-                "user": {
-                    "username": username,
-                    "role": user["role"],
-                    "permissions": user["permissions"]
-                }
+                "user": user["public"]
             }
             
         except Exception as e:
@@ -281,7 +436,8 @@ class AuthMiddleware:
             if username not in self.users:
                 return {"success": False, "error": "User not found"}
             
-            del self.users[username]
+            if self.users.pop(username)["role"] == "admin":
+                self._admin_count -= 1
             
             logger.info(f"User deleted: {username}")
             
@@ -293,19 +449,12 @@ class AuthMiddleware:
     
     def get_all_users(self) -> Dict[str, Dict[str, Any]]:
         """Получение всех пользователей (без паролей)"""
-        users = {}
-        for username, user_data in self.users.items():
-            users[username] = {
-                "username": user_data["username"],
-                "role": user_data["role"],
-                "permissions": user_data["permissions"]
-            }
-        return users
+        return {username: user_data["public"] for username, user_data in self.users.items()}
     
     def get_user_stats(self) -> Dict[str, Any]:
         """Получение статистики пользователей"""
         total_users = len(self.users)
-        admin_users = sum(1 for user in self.users.values() if user["role"] == "admin")
+        admin_users = self._admin_count
         regular_users = total_users - admin_users
         
         return {
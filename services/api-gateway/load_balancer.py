@@ -2,12 +2,16 @@
 Балансировщик нагрузки для API Gateway
 Распределение запросов между экземплярами сервисов
 """
+import itertools
+from array import array
+import math
 import random
 import time
-from typing import Dict, List, Optional, Any
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Any, Tuple
 import logging
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from utils.logger import get_logger
 
@@ -20,8 +24,9 @@ class LoadBalancingStrategy(Enum):
     LEAST_CONNECTIONS = "least_connections"
     WEIGHTED_ROUND_ROBIN = "weighted_round_robin"
     LEAST_RESPONSE_TIME = "least_response_time"
+    P2C = "p2c"
 
-@dataclass
+@dataclass(slots=True)
 class ServiceInstance:
     """Экземпляр сервиса"""
     url: str
@@ -30,37 +35,137 @@ class ServiceInstance:
     response_time: float = 0.0
     last_used: float = 0.0
     is_healthy: bool = True
+    ws_url: str = field(default="", init=False)
+    
+    def __post_init__(self):
+        # http:// -> ws://, https:// -> wss://
+        self.ws_url = self.url.replace("http", "ws", 1) if self.url.startswith("http") else self.url
+
+class _InstanceHeap:
+    """Индексированная min-куча экземпляров по значению key(instance)"""
+    
+    def __init__(self, instances: List[ServiceInstance], key):
+        self.key = key
+        # Отсортированный список уже является корректной кучей
+        self.items = sorted(instances, key=key)
+        self.positions = {instance.url: index for index, instance in enumerate(self.items)}
+    
+    def top(self) -> ServiceInstance:
+        """Экземпляр с минимальным ключом"""
+        return self.items[0]
+    
+    def update(self, instance: ServiceInstance):
+        """Восстановление свойства кучи после изменения ключа экземпляра"""
+        index = self.positions.get(instance.url)
+        if index is not None:
+            self._sift_down(self._sift_up(index))
+    
+    def _swap(self, i: int, j: int):
+        items = self.items
+        items[i], items[j] = items[j], items[i]
+        self.positions[items[i].url] = i
+        self.positions[items[j].url] = j
+    
+    def _sift_up(self, index: int) -> int:
+        key = self.key
+        items = self.items
+        while index > 0:
+            parent = (index - 1) >> 1
+            if key(items[index]) >= key(items[parent]):
+                break
+            self._swap(index, parent)
+            index = parent
+        return index
+    
+    def _sift_down(self, index: int):
+        key = self.key
+        items = self.items
+        size = len(items)
+        while True:
+            smallest = index
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < size and key(items[child]) < key(items[smallest]):
+                    smallest = child
+            if smallest == index:
+                return
+            self._swap(index, smallest)
+            index = smallest
+
+def _connections_key(instance: ServiceInstance) -> int:
+    return instance.active_connections
+
+def _response_time_key(instance: ServiceInstance) -> float:
+    # Экземпляры без данных о времени ответа уходят в конец кучи
+    return instance.response_time if instance.response_time > 0 else math.inf
 
 class LoadBalancer:
     """Балансировщик нагрузки"""
     
-    def __init__(self, service_registry, strategy: LoadBalancingStrategy = LoadBalancingStrategy.ROUND_ROBIN):
+    # Ниже этого числа экземпляров линейный поиск быстрее поддержки кучи
+    HEAP_MIN_INSTANCES = 16
+    
+    def __init__(self, service_registry, strategy: LoadBalancingStrategy = LoadBalancingStrategy.ROUND_ROBIN,
+                 response_time_alpha: float = 0.2):
         self.service_registry = service_registry
         self.strategy = strategy
+        # Коэффициент сглаживания EWMA для времени ответа
+        self.response_time_alpha = response_time_alpha
         self.service_instances: Dict[str, List[ServiceInstance]] = {}
-        self.round_robin_counters: Dict[str, int] = {}
+        self._instances_view = MappingProxyType(self.service_instances)
+        # Индекс экземпляра в service_instances[service_name] по URL
+        self._url_index: Dict[str, Dict[str, int]] = {}
+        self.round_robin_counters: Dict[str, itertools.count] = {}
+        # Здоровые экземпляры, пересчитываются только при изменении состава или здоровья
+        self._healthy_instances: Dict[str, List[ServiceInstance]] = {}
+        # Счетчики соединений здоровых экземпляров в виде плотного массива (параллельно списку)
+        self._conn_counts: Dict[str, array] = {}
+        self._healthy_positions: Dict[str, Dict[str, int]] = {}
+        # Агрегаты для статистики, обновляются в точках изменения экземпляров
+        self._service_stats: Dict[str, Dict[str, float]] = {}
+        # Состояние interleaved WRR: (индекс, текущий вес, НОД весов, максимальный вес)
+        self._wrr_state: Dict[str, Tuple[int, int, int, int]] = {}
+        # Кучи здоровых экземпляров по числу соединений и времени ответа
+        self._conn_heaps: Dict[str, _InstanceHeap] = {}
+        self._rt_heaps: Dict[str, _InstanceHeap] = {}
+        # Срок действия результата разрешения через реестр (time.monotonic)
+        # для сервисов, экземпляр которых получен из реестра
+        self._resolved_until: Dict[str, float] = {}
+        self.resolve_ttl = 20.0  # секунды
+        # id маршрутов реестра по имени сервиса (постоянны для имени)
+        self._route_ids: Dict[str, int] = {}
+        
+        # Таблица стратегий: выбор выполняется одним обращением к словарю
+        self._dispatch = {
+            LoadBalancingStrategy.ROUND_ROBIN: self._round_robin_selection,
+            LoadBalancingStrategy.RANDOM: self._random_selection,
+            LoadBalancingStrategy.LEAST_CONNECTIONS: self._least_connections_selection,
+            LoadBalancingStrategy.WEIGHTED_ROUND_ROBIN: self._weighted_round_robin_selection,
+            LoadBalancingStrategy.LEAST_RESPONSE_TIME: self._least_response_time_selection,
+            LoadBalancingStrategy.P2C: self._p2c_selection
+        }
+        # По умолчанию используем round robin
+        self._selector = self._dispatch.get(strategy, self._round_robin_selection)
         
         logger.info(f"Load balancer initialized with strategy: {strategy.value}")
     
     async def get_service_url(self, service_name: str) -> Optional[str]:
         """Получение URL сервиса с балансировкой нагрузки"""
+        instance = await self.get_service_instance(service_name)
+        return instance.url if instance else None
+    
+    async def get_service_instance(self, service_name: str) -> Optional[ServiceInstance]:
+        """Выбор экземпляра сервиса с балансировкой нагрузки"""
         try:
             # Получение экземпляров сервиса
             instances = self.service_instances.get(service_name, [])
             
-            if not instances:
-                # Если нет экземпляров, попробуем получить из реестра
-                service_url = await self.service_registry.get_service_url(service_name)
-                if service_url:
-                    # Создание экземпляра по умолчанию
-                    instance = ServiceInstance(url=service_url)
-                    self.service_instances[service_name] = [instance]
-                    instances = [instance]
-                else:
+            if not instances or service_name in self._resolved_until:
+                # Экземпляр из реестра: обращаемся к реестру не чаще раза в resolve_ttl
+                instances = await self._resolve_from_registry(service_name, instances)
+                if not instances:
                     return None
             
-            # Фильтрация здоровых экземпляров
-            healthy_instances = [inst for inst in instances if inst.is_healthy]
+            healthy_instances = self._healthy_instances.get(service_name)
             
             if not healthy_instances:
                 logger.warning(f"No healthy instances available for service: {service_name}")
@@ -72,9 +177,14 @@ class LoadBalancer:
             if selected_instance:
                 # Обновление статистики
                 selected_instance.active_connections += 1
-                selected_instance.last_used = time.time()
+                self._service_stats[service_name]["total_connections"] += 1
+                selected_instance.last_used = time.monotonic()
+                self._adjust_conn_count(service_name, selected_instance.url, 1)
+                heap = self._conn_heaps.get(service_name)
+                if heap is not None:
+                    heap.update(selected_instance)
                 
-                return selected_instance.url
+                return selected_instance
             
             return None
             
@@ -82,87 +192,173 @@ class LoadBalancer:
             logger.error(f"Error getting service URL for {service_name}: {e}")
             return None
     
+    async def _resolve_from_registry(self, service_name: str, instances: List[ServiceInstance]) -> List[ServiceInstance]:
+        """Получение экземпляра сервиса из реестра с кэшированием на resolve_ttl"""
+        now = time.monotonic()
+        if now < self._resolved_until.get(service_name, 0.0):
+            return instances
+        
+        route_id = self._route_ids.get(service_name)
+        if route_id is None:
+            route_id = self.service_registry.get_route_id(service_name)
+            if route_id is not None:
+                self._route_ids[service_name] = route_id
+        
+        service_url = self.service_registry.get_route_url(route_id) if route_id is not None else None
+        self._resolved_until[service_name] = now + self.resolve_ttl
+        
+        if not service_url:
+            self.service_instances.pop(service_name, None)
+            self._url_index.pop(service_name, None)
+            self._refresh_healthy_instances(service_name)
+            return []
+        
+        if len(instances) == 1 and instances[0].url == service_url:
+            # Реестр возвращает URL только здоровых сервисов
+            if not instances[0].is_healthy:
+                instances[0].is_healthy = True
+                self._refresh_healthy_instances(service_name)
+            return instances
+        
+        # Создание экземпляра по умолчанию
+        instance = ServiceInstance(url=service_url)
+        self.service_instances[service_name] = [instance]
+        self._url_index[service_name] = {service_url: 0}
+        self._refresh_healthy_instances(service_name)
+        return [instance]
+    
     def _select_instance(self, service_name: str, instances: List[ServiceInstance]) -> Optional[ServiceInstance]:
         """Выбор экземпляра сервиса по стратегии"""
         if not instances:
             return None
         
-        if self.strategy == LoadBalancingStrategy.ROUND_ROBIN:
-            return self._round_robin_selection(service_name, instances)
-        elif self.strategy == LoadBalancingStrategy.RANDOM:
-            return self._random_selection(instances)
-        elif self.strategy == LoadBalancingStrategy.LEAST_CONNECTIONS:
-            return self._least_connections_selection(instances)
-        elif self.strategy == LoadBalancingStrategy.WEIGHTED_ROUND_ROBIN:
-            return self._weighted_round_robin_selection(service_name, instances)
-        elif self.strategy == LoadBalancingStrategy.LEAST_RESPONSE_TIME:
-            return self._least_response_time_selection(instances)
-        else:
-            # По умолчанию используем round robin
-            return self._round_robin_selection(service_name, instances)
+        return self._selector(service_name, instances)
     
     def _round_robin_selection(self, service_name: str, instances: List[ServiceInstance]) -> ServiceInstance:
         """Выбор экземпляра по принципу round robin"""
-        if service_name not in self.round_robin_counters:
-            self.round_robin_counters[service_name] = 0
+        # next() у itertools.count атомарен под GIL и не требует записи обратно в словарь
+        counter = self.round_robin_counters.get(service_name)
+        if counter is None:
+            counter = self.round_robin_counters[service_name] = itertools.count()
         
-        counter = self.round_robin_counters[service_name]
-        selected_instance = instances[counter % len(instances)]
-        
-        self.round_robin_counters[service_name] = (counter + 1) % len(instances)
-        
-        return selected_instance
+        return instances[next(counter) % len(instances)]
     
-    def _random_selection(self, instances: List[ServiceInstance]) -> ServiceInstance:
+    def _random_selection(self, service_name: str, instances: List[ServiceInstance]) -> ServiceInstance:
         """Случайный выбор экземпляра"""
         return random.choice(instances)
     
-    def _least_connections_selection(self, instances: List[ServiceInstance]) -> ServiceInstance:
+    def _least_connections_selection(self, service_name: str, instances: List[ServiceInstance]) -> ServiceInstance:
         """Выбор экземпляра с наименьшим количеством соединений"""
-        return min(instances, key=lambda inst: inst.active_connections)
+        if len(instances) < self.HEAP_MIN_INSTANCES:
+            counts = self._conn_counts.get(service_name)
+            if counts is None or len(counts) != len(instances):
+                return min(instances, key=_connections_key)
+            # Поиск минимума по array без обращения к атрибутам экземпляров
+            return instances[min(range(len(counts)), key=counts.__getitem__)]
+        
+        heap = self._conn_heaps.get(service_name)
+        if heap is None:
+            heap = self._conn_heaps[service_name] = _InstanceHeap(instances, _connections_key)
+        return heap.top()
     
     def _weighted_round_robin_selection(self, service_name: str, instances: List[ServiceInstance]) -> ServiceInstance:
-        """Взвешенный round robin выбор"""
-        # Создание списка экземпляров с учетом весов
-        weighted_instances = []
-        for instance in instances:
-            for _ in range(instance.weight):
-                weighted_instances.append(instance)
+        """Взвешенный round robin выбор (interleaved WRR, как в LVS)"""
+        state = self._wrr_state.get(service_name)
+        if state is None:
+            weights = [instance.weight for instance in instances]
+            state = (-1, 0, math.gcd(*weights), max(weights))
         
-        if not weighted_instances:
+        index, current_weight, gcd_weight, max_weight = state
+        if max_weight <= 0:
             return instances[0]
         
-        # Round robin по взвешенному списку
-        if service_name not in self.round_robin_counters:
-            self.round_robin_counters[service_name] = 0
-        
-        counter = self.round_robin_counters[service_name]
-        selected_instance = weighted_instances[counter % len(weighted_instances)]
-        
-        self.round_robin_counters[service_name] = (counter + 1) % len(weighted_instances)
-        
-        return selected_instance
+        count = len(instances)
+        while True:
+            index = (index + 1) % count
+            if index == 0:
+                current_weight -= gcd_weight
+                if current_weight <= 0:
+                    current_weight = max_weight
+            if instances[index].weight >= current_weight:
+                self._wrr_state[service_name] = (index, current_weight, gcd_weight, max_weight)
+                return instances[index]
     
-    def _least_response_time_selection(self, instances: List[ServiceInstance]) -> ServiceInstance:
+    def _least_response_time_selection(self, service_name: str, instances: List[ServiceInstance]) -> ServiceInstance:
         """Выбор экземпляра с наименьшим временем ответа"""
-        # Фильтрация экземпляров с известным временем ответа
-        instances_with_response_time = [inst for inst in instances if inst.response_time > 0]
-        
-        if instances_with_response_time:
-            return min(instances_with_response_time, key=lambda inst: inst.response_time)
+        if len(instances) < self.HEAP_MIN_INSTANCES:
+            selected_instance = min(instances, key=_response_time_key)
         else:
-            # Если нет данных о времени ответа, используем round robin
+            heap = self._rt_heaps.get(service_name)
+            if heap is None:
+                heap = self._rt_heaps[service_name] = _InstanceHeap(instances, _response_time_key)
+            selected_instance = heap.top()
+        
+        if selected_instance.response_time > 0:
+            return selected_instance
+        # Если нет данных о времени ответа, используем первый экземпляр
+        return instances[0]
+    
+    def _p2c_selection(self, service_name: str, instances: List[ServiceInstance]) -> ServiceInstance:
+        """Выбор менее загруженного из двух случайных экземпляров (power of two choices)"""
+        if len(instances) < 2:
             return instances[0]
+        
+        first, second = random.sample(instances, 2)
+        return first if first.active_connections <= second.active_connections else second
+    
+    def _refresh_healthy_instances(self, service_name: str):
+        """Пересчет здоровых экземпляров и статистики сервиса, сброс состояния выбора"""
+        instances = self.service_instances.get(service_name)
+        if instances:
+            healthy_instances = [inst for inst in instances if inst.is_healthy]
+            self._healthy_instances[service_name] = healthy_instances
+            self._conn_counts[service_name] = array('i', [inst.active_connections for inst in healthy_instances])
+            self._healthy_positions[service_name] = {
+                inst.url: index for index, inst in enumerate(healthy_instances)
+            }
+            self._service_stats[service_name] = {
+                "total_instances": len(instances),
+                "healthy_instances": len(healthy_instances),
+                "total_connections": sum(inst.active_connections for inst in instances),
+                "response_time_sum": sum(inst.response_time for inst in instances)
+            }
+        else:
+            self._healthy_instances.pop(service_name, None)
+            self._conn_counts.pop(service_name, None)
+            self._healthy_positions.pop(service_name, None)
+            self._service_stats.pop(service_name, None)
+        self._wrr_state.pop(service_name, None)
+        self._conn_heaps.pop(service_name, None)
+        self._rt_heaps.pop(service_name, None)
+    
+    def _find_instance(self, service_name: str, url: str) -> Optional[ServiceInstance]:
+        """Поиск экземпляра сервиса по URL"""
+        index = self._url_index.get(service_name, {}).get(url)
+        if index is None:
+            return None
+        return self.service_instances[service_name][index]
+    
+    def _adjust_conn_count(self, service_name: str, url: str, delta: int):
+        """Синхронизация массива счетчиков соединений с экземпляром"""
+        index = self._healthy_positions.get(service_name, {}).get(url)
+        if index is not None:
+            self._conn_counts[service_name][index] += delta
     
     async def add_service_instance(self, service_name: str, url: str, weight: int = 1) -> bool:
         """Добавление экземпляра сервиса"""
         try:
-            instance = ServiceInstance(url=url, weight=weight)
-            
-            if service_name not in self.service_instances:
-                self.service_instances[service_name] = []
+            instances = self.service_instances.setdefault(service_name, [])
+            url_index = self._url_index.setdefault(service_name, {})
             
-            self.service_instances[service_name].append(instance)
+            if url in url_index:
+                # Повторное добавление обновляет вес существующего экземпляра
+                instances[url_index[url]].weight = weight
+            else:
+                url_index[url] = len(instances)
+                instances.append(ServiceInstance(url=url, weight=weight))
+            self._refresh_healthy_instances(service_name)
+            # Явно добавленные экземпляры не переразрешаются через реестр
+            self._resolved_until.pop(service_name, None)
             
             logger.info(f"Added service instance: {service_name} at {url} (weight: {weight})")
             return True
@@ -175,13 +371,22 @@ class LoadBalancer:
         """Удаление экземпляра сервиса"""
         try:
             if service_name in self.service_instances:
-                self.service_instances[service_name] = [
-                    inst for inst in self.service_instances[service_name] 
-                    if inst.url != url
-                ]
+                instances = self.service_instances[service_name]
+                url_index = self._url_index[service_name]
+                index = url_index.pop(url, None)
+                
+                if index is not None:
+                    # Удаление перестановкой последнего элемента на место удаляемого
+                    last = instances.pop()
+                    if index < len(instances):
+                        instances[index] = last
+                        url_index[last.url] = index
                 
-                if not self.service_instances[service_name]:
+                if not instances:
                     del self.service_instances[service_name]
+                    del self._url_index[service_name]
+                self._refresh_healthy_instances(service_name)
+                self._resolved_until.pop(service_name, None)
                 
                 logger.info(f"Removed service instance: {service_name} at {url}")
                 return True
@@ -196,12 +401,17 @@ class LoadBalancer:
     async def update_instance_health(self, service_name: str, url: str, is_healthy: bool) -> bool:
         """Обновление состояния здоровья экземпляра"""
         try:
-            if service_name in self.service_instances:
-                for instance in self.service_instances[service_name]:
-                    if instance.url == url:
-                        instance.is_healthy = is_healthy
-                        logger.debug(f"Updated health for {service_name} at {url}: {is_healthy}")
-                        return True
+            instance = self._find_instance(service_name, url)
+            if instance is not None:
+                if instance.is_healthy != is_healthy:
+                    instance.is_healthy = is_healthy
+                    # Набор здоровых экземпляров изменился
+                    self._refresh_healthy_instances(service_name)
+                if not is_healthy and service_name in self._resolved_until:
+                    # Экземпляр из реестра будет переразрешен при следующем запросе
+                    self._resolved_until[service_name] = 0.0
+                logger.debug(f"Updated health for {service_name} at {url}: {is_healthy}")
+                return True
             
             logger.warning(f"Instance not found for health update: {service_name} at {url}")
             return False
@@ -213,12 +423,19 @@ class LoadBalancer:
     async def update_instance_response_time(self, service_name: str, url: str, response_time: float) -> bool:
         """Обновление времени ответа экземпляра"""
         try:
-            if service_name in self.service_instances:
-                for instance in self.service_instances[service_name]:
-                    if instance.url == url:
-                        instance.response_time = response_time
-                        logger.debug(f"Updated response time for {service_name} at {url}: {response_time:.3f}s")
-                        return True
+            instance = self._find_instance(service_name, url)
+            if instance is not None:
+                # EWMA сглаживает единичные всплески и не дает трафику "перескакивать"
+                previous = instance.response_time
+                if previous > 0:
+                    response_time = previous + self.response_time_alpha * (response_time - previous)
+                self._service_stats[service_name]["response_time_sum"] += response_time - previous
+                instance.response_time = response_time
+                heap = self._rt_heaps.get(service_name)
+                if heap is not None:
+                    heap.update(instance)
+                logger.debug(f"Updated response time for {service_name} at {url}: {response_time:.3f}s")
+                return True
             
             logger.warning(f"Instance not found for response time update: {service_name} at {url}")
             return False
@@ -227,26 +444,42 @@ class LoadBalancer:
             logger.error(f"Failed to update instance response time {service_name}: {e}")
             return False
     
+    def release_connection(self, service_name: str, url: str):
+        """Освобождение соединения после завершения запроса к экземпляру"""
+        instance = self._find_instance(service_name, url)
+        if instance is not None and instance.active_connections > 0:
+            instance.active_connections -= 1
+            self._service_stats[service_name]["total_connections"] -= 1
+            self._adjust_conn_count(service_name, url, -1)
+            heap = self._conn_heaps.get(service_name)
+            if heap is not None:
+                heap.update(instance)
+    
     def get_service_instances(self, service_name: str) -> List[ServiceInstance]:
         """Получение экземпляров сервиса"""
         return self.service_instances.get(service_name, [])
     
-    def get_all_instances(self) -> Dict[str, List[ServiceInstance]]:
-        """Получение всех экземпляров"""
-        return self.service_instances.copy()
+    def get_all_instances(self) -> Mapping[str, List[ServiceInstance]]:
+        """Получение всех экземпляров (представление только для чтения)"""
+        return self._instances_view
     
     def get_load_balancer_statistics(self) -> Dict[str, Any]:
         """Получение статистики балансировщика нагрузки"""
-        total_instances = sum(len(instances) for instances in self.service_instances.values())
-        healthy_instances = sum(
-            len([inst for inst in instances if inst.is_healthy]) 
-            for instances in self.service_instances.values()
-        )
+        total_instances = 0
+        healthy_instances = 0
+        total_connections = 0
+        services = {}
         
-        total_connections = sum(
-            sum(inst.active_connections for inst in instances)
-            for instances in self.service_instances.values()
-        )
+        for service_name, stats in self._service_stats.items():
+            total_instances += stats["total_instances"]
+            healthy_instances += stats["healthy_instances"]
+            total_connections += stats["total_connections"]
+            services[service_name] = {
+                "total_instances": stats["total_instances"],
+                "healthy_instances": stats["healthy_instances"],
+                "total_connections": stats["total_connections"],
+                "average_response_time": stats["response_time_sum"] / stats["total_instances"]
+            }
         
         return {
             "strategy": self.strategy.value,
@@ -254,27 +487,29 @@ class LoadBalancer:
             "healthy_instances": healthy_instances,
             "unhealthy_instances": total_instances - healthy_instances,
             "total_active_connections": total_connections,
-            "services": {
-                service_name: {
-                    "total_instances": len(instances),
-                    "healthy_instances": len([inst for inst in instances if inst.is_healthy]),
-                    "total_connections": sum(inst.active_connections for inst in instances),
-                    "average_response_time": sum(inst.response_time for inst in instances) / len(instances) if instances else 0
-                }
-                for service_name, instances in self.service_instances.items()
-            }
+            "services": services
         }
     
     def set_strategy(self, strategy: LoadBalancingStrategy):
         """Изменение стратегии балансировки нагрузки"""
         self.strategy = strategy
+        self._selector = self._dispatch.get(strategy, self._round_robin_selection)
         logger.info(f"Load balancing strategy changed to: {strategy.value}")
     
     async def cleanup(self):
         """Очистка ресурсов"""
         try:
             self.service_instances.clear()
+            self._url_index.clear()
             self.round_robin_counters.clear()
+            self._wrr_state.clear()
+            self._healthy_instances.clear()
+            self._conn_counts.clear()
+            self._healthy_positions.clear()
+            self._service_stats.clear()
+            self._conn_heaps.clear()
+            self._rt_heaps.clear()
+            self._resolved_until.clear()
             logger.info("Load balancer cleanup completed")
             
         except Exception as e:
@@ -3,6 +3,7 @@ API Gateway для Jarvis AI Assistant
 Маршрутизация запросов между микросервисами
 """
 import asyncio
+import re
 import sys
 import os
 from pathlib import Path
@@ -13,13 +14,16 @@ sys.path.append(str(Path(__file__).parent.parent.parent / "shared"))
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.convertors import Convertor, register_url_convertor
 import uvicorn
-import json
+import orjson
 import time
 from typing import Dict, List, Optional, Any
 import logging
 import httpx
+import aiohttp
 from contextlib import asynccontextmanager
 
 from utils.config import get_config
@@ -41,7 +45,8 @@ performance_logger = get_performance_logger("api-gateway")
 app = FastAPI(
     title="Jarvis API Gateway",
     description="API Gateway для Jarvis AI Assistant",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Middleware
@@ -65,11 +70,16 @@ rate_limiter: Optional[RateLimiter] = None
 
 # HTTP клиент для проксирования запросов
 http_client: Optional[httpx.AsyncClient] = None
+# Сессия для WebSocket соединений к сервисам (httpx не поддерживает WebSocket)
+ws_session: Optional[aiohttp.ClientSession] = None
+
+# Заголовки ответа сервиса, которые не передаются клиенту при потоковой отдаче тела
+EXCLUDED_RESPONSE_HEADERS = ("content-length", "transfer-encoding", "content-encoding")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
-    global db_manager, service_registry, load_balancer, websocket_manager, auth_middleware, rate_limiter, http_client
+    global db_manager, service_registry, load_balancer, websocket_manager, auth_middleware, rate_limiter, http_client, ws_session
     
     try:
         # Инициализация базы данных
@@ -91,6 +101,7 @@ async def lifespan(app: FastAPI):
             timeout=httpx.Timeout(30.0),
             limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
         )
+        ws_session = aiohttp.ClientSession()
         
         # Регистрация сервисов
         await service_registry.register_service("voice-service", "http://voice-service:8001")
@@ -113,6 +124,9 @@ async def lifespan(app: FastAPI):
         if http_client:
             await http_client.aclose()
         
+        if ws_session:
+            await ws_session.close()
+        
         if db_manager:
             await db_manager.close()
         
@@ -127,8 +141,9 @@ async def auth_and_rate_limit_middleware(request: Request, call_next):
     try:
         # Rate limiting
         client_ip = request.client.host
-        if not await rate_limiter.is_allowed(client_ip):
-            return JSONResponse(
+        # RateLimiter работает в памяти процесса и синхронен
+        if not rate_limiter.is_allowed(client_ip):
+            return ORJSONResponse(
                 status_code=429,
                 content={"error": "Rate limit exceeded"}
             )
@@ -137,16 +152,16 @@ async def auth_and_rate_limit_middleware(request: Request, call_next):
         if request.url.path.startswith("/api/protected/"):
             auth_result = await auth_middleware.authenticate_request(request)
             if not auth_result["authenticated"]:
-                return JSONResponse(
+                return ORJSONResponse(
                     status_code=401,
                     content={"error": "Authentication required"}
                 )
             request.state.user = auth_result["user"]
         
         # Логирование запроса
-        start_time = time.time()
+        start_time = time.monotonic()
         response = await call_next(request)
-        process_time = time.time() - start_time
+        process_time = time.monotonic() - start_time
         
         # Обновление метрик
         metrics_logger.increment_counter("http_requests", labels={
@@ -160,7 +175,7 @@ async def auth_and_rate_limit_middleware(request: Request, call_next):
         
     except Exception as e:
         logger.error(f"Middleware error: {e}")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"error": "Internal server error"}
         )
@@ -171,8 +186,12 @@ async def health_check():
     services_status = {}
     
     if service_registry:
-        for service_name in service_registry.get_registered_services():
-            services_status[service_name] = await service_registry.is_service_healthy(service_name)
+        # Проверки сервисов выполняются параллельно
+        service_names = service_registry.get_registered_services()
+        statuses = await asyncio.gather(
+            *(service_registry.is_service_healthy(name) for name in service_names)
+        )
+        services_status = dict(zip(service_names, statuses))
     
     return {
         "status": "healthy",
@@ -193,40 +212,23 @@ async def get_services():
     if not service_registry:
         raise HTTPException(status_code=503, detail="Service registry not initialized")
     
-    services = service_registry.get_all_services()
-    return {"services": services}
-
-# Проксирование запросов к сервисам
-@app.api_route("/api/voice/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
-async def proxy_voice_service(request: Request, path: str):
-    """Проксирование запросов к Voice Service"""
-    return await proxy_request("voice-service", request, path)
+    # Список сервисов уже сериализован реестром
+    services_json = service_registry.get_all_services_json()
+    return Response(content=b'{"services":' + services_json + b'}', media_type="application/json")
 
-@app.api_route("/api/brain/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
-async def proxy_brain_service(request: Request, path: str):
-    """Проксирование запросов к Brain Service"""
-    return await proxy_request("brain-service", request, path)
-
-@app.api_route("/api/tasks/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
-async def proxy_task_service(request: Request, path: str):
-    """Проксирование запросов к Task Service"""
-    return await proxy_request("task-service", request, path)
-
-@app.api_route("/api/code/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
-async def proxy_code_service(request: Request, path: str):
-    """Проксирование запросов к Code Service"""
-    return await proxy_request("code-service", request, path)
-
-@app.api_route("/api/learning/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
-async def proxy_learning_service(request: Request, path: str):
-    """Проксирование запросов к Learning Service"""
-    return await proxy_request("learning-service", request, path)
+async def _finish_proxied_response(response: httpx.Response, service_name: str, service_url: str):
+    """Закрытие ответа сервиса и освобождение соединения после передачи тела клиенту"""
+    try:
+        await response.aclose()
+    finally:
+        load_balancer.release_connection(service_name, service_url)
 
 async def proxy_request(service_name: str, request: Request, path: str):
     """Проксирование HTTP запроса к сервису"""
     if not service_registry or not http_client:
         raise HTTPException(status_code=503, detail="Service registry or HTTP client not initialized")
     
+    service_url = None
     try:
         # Получение URL сервиса
         service_url = await load_balancer.get_service_url(service_name)
@@ -238,30 +240,37 @@ async def proxy_request(service_name: str, request: Request, path: str):
         if request.query_params:
             target_url += f"?{request.query_params}"
         
-        # Подготовка заголовков
-        headers = dict(request.headers)
-        headers.pop("host", None)  # Удаляем host заголовок
+        # Подготовка заголовков (сырые пары байтов, без host)
+        headers = [(key, value) for key, value in request.headers.raw if key != b"host"]
         
-        # Подготовка тела запроса
+        # Подготовка тела запроса: передается сервису потоком, без буферизации
         body = None
         if request.method in ["POST", "PUT", "PATCH"]:
-            body = await request.body()
+            body = request.stream()
         
         # Выполнение запроса
         async with performance_logger.time_operation(f"proxy_request_{service_name}"):
-            response = await http_client.request(
+            upstream_request = http_client.build_request(
                 method=request.method,
                 url=target_url,
                 headers=headers,
                 content=body
             )
+            response = await http_client.send(upstream_request, stream=True)
         
-        # Возврат ответа
-        return JSONResponse(
-            content=response.json() if response.headers.get("content-type", "").startswith("application/json") else response.text,
+        # Возврат ответа: тело передается потоком, без разбора JSON.
+        # Соединение занято, пока тело не передано - его освобождает фоновая задача ответа
+        streaming_response = StreamingResponse(
+            response.aiter_bytes(),
             status_code=response.status_code,
-            headers=dict(response.headers)
+            headers={
+                key: value for key, value in response.headers.items()
+                if key.lower() not in EXCLUDED_RESPONSE_HEADERS
+            },
+            background=BackgroundTask(_finish_proxied_response, response, service_name, service_url)
         )
+        service_url = None
+        return streaming_response
         
     except httpx.TimeoutException:
         logger.error(f"Timeout when proxying request to {service_name}")
@@ -272,6 +281,10 @@ async def proxy_request(service_name: str, request: Request, path: str):
     except Exception as e:
         logger.error(f"Error proxying request to {service_name}: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        # Ответ не был возвращен (ошибка) - соединение освобождается сразу
+        if service_url:
+            load_balancer.release_connection(service_name, service_url)
 
 # WebSocket проксирование
 @app.websocket("/ws/voice")
@@ -291,52 +304,59 @@ async def websocket_tasks_proxy(websocket: WebSocket):
 
 async def websocket_proxy(service_name: str, websocket: WebSocket, path: str):
     """Проксирование WebSocket соединения к сервису"""
-    if not service_registry:
+    if not service_registry or not ws_session:
         await websocket.close(code=1011, reason="Service registry not initialized")
         return
     
+    instance = None
     try:
-        # Получение URL сервиса
-        service_url = await load_balancer.get_service_url(service_name)
-        if not service_url:
+        # Получение экземпляра сервиса
+        instance = await load_balancer.get_service_instance(service_name)
+        if not instance:
             await websocket.close(code=1011, reason=f"Service {service_name} not available")
             return
         
         # Подключение к сервису
-        target_url = service_url.replace("http://", "ws://").replace("https://", "wss://") + path
+        target_url = instance.ws_url + path
         
-        async with httpx.AsyncClient() as client:
-            async with client.websocket_connect(target_url) as target_websocket:
-                # Принятие входящего соединения
-                await websocket.accept()
-                
-                # Создание задач для двунаправленной передачи данных
-                async def forward_to_target():
-                    try:
-                        while True:
-                            data = await websocket.receive_text()
-                            await target_websocket.send_text(data)
-                    except WebSocketDisconnect:
-                        pass
-                
-                async def forward_to_client():
-                    try:
-                        while True:
-                            data = await target_websocket.receive_text()
-                            await websocket.send_text(data)
-                    except WebSocketDisconnect:
-                        pass
-                
-                # Запуск задач
-                await asyncio.gather(
-                    forward_to_target(),
-                    forward_to_client(),
-                    return_exceptions=True
-                )
+        async with ws_session.ws_connect(target_url) as target_websocket:
+            # Принятие входящего соединения
+            await websocket.accept()
+            
+            # Создание задач для двунаправленной передачи данных
+            async def forward_to_target():
+                try:
+                    while True:
+                        data = await websocket.receive_text()
+                        await target_websocket.send_str(data)
+                except WebSocketDisconnect:
+                    pass
+                finally:
+                    # Закрытие соединения с сервисом завершает forward_to_client
+                    await target_websocket.close()
+            
+            async def forward_to_client():
+                try:
+                    async for message in target_websocket:
+                        if message.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        await websocket.send_text(message.data)
+                except WebSocketDisconnect:
+                    pass
+            
+            # Запуск задач
+            await asyncio.gather(
+                forward_to_target(),
+                forward_to_client(),
+                return_exceptions=True
+            )
                 
     except Exception as e:
         logger.error(f"WebSocket proxy error for {service_name}: {e}")
         await websocket.close(code=1011, reason="Internal server error")
+    finally:
+        if instance:
+            load_balancer.release_connection(service_name, instance.url)
 
 # Универсальный WebSocket endpoint
 @app.websocket("/ws")
@@ -346,9 +366,8 @@ async def universal_websocket(websocket: WebSocket):
     
     try:
         while True:
-            # Получение сообщения
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            # Получение сообщения (JSON или MessagePack, в зависимости от подпротокола)
+            message, data = await websocket_manager.receive_message(websocket)
             
             # Маршрутизация сообщения к соответствующему сервису
             service_name = message.get("service")
@@ -370,28 +389,31 @@ async def universal_websocket(websocket: WebSocket):
             
             # Отправка сообщения к сервису
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        f"{service_url}/ws/message",
-                        json=message,
-                        timeout=30.0
-                    )
+                # Сообщение уже в JSON - отправляем исходный текст без повторной сериализации
+                response = await http_client.post(
+                    f"{service_url}/ws/message",
+                    content=data if data is not None else orjson.dumps(message),
+                    headers={"Content-Type": "application/json"},
+                    timeout=30.0
+                )
+                
+                if response.status_code == 200:
+                    result = orjson.loads(response.content)
+                    await websocket_manager.send_message(websocket, result)
+                else:
+                    await websocket_manager.send_message(websocket, {
+                        "type": "error",
+                        "message": f"Service error: {response.status_code}"
+                    })
                     
-                    if response.status_code == 200:
-                        result = response.json()
-                        await websocket_manager.send_message(websocket, result)
-                    else:
-                        await websocket_manager.send_message(websocket, {
-                            "type": "error",
-                            "message": f"Service error: {response.status_code}"
-                        })
-                        
             except Exception as e:
                 logger.error(f"Error forwarding message to {service_name}: {e}")
                 await websocket_manager.send_message(websocket, {
                     "type": "error",
                     "message": "Service communication error"
                 })
+            finally:
+                load_balancer.release_connection(service_name, service_url)
                 
     except WebSocketDisconnect:
         await websocket_manager.disconnect(websocket)
@@ -407,7 +429,7 @@ async def login(request: Request):
         raise HTTPException(status_code=503, detail="Auth middleware not initialized")
     
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
         result = await auth_middleware.authenticate_user(
             body.get("username"),
             body.get("password")
@@ -433,7 +455,7 @@ async def refresh_token(request: Request):
         raise HTTPException(status_code=503, detail="Auth middleware not initialized")
     
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
         result = await auth_middleware.refresh_token(body.get("refresh_token"))
         
         if result["success"]:
@@ -449,6 +471,35 @@ async def refresh_token(request: Request):
         logger.error(f"Token refresh error: {e}")
         raise HTTPException(status_code=500, detail="Token refresh error")
 
+# Проксирование запросов к сервисам
+# Префикс пути -> имя сервиса в реестре
+SERVICE_MAP = {
+    "voice": "voice-service",
+    "brain": "brain-service",
+    "tasks": "task-service",
+    "code": "code-service",
+    "learning": "learning-service"
+}
+
+class ServicePrefixConvertor(Convertor):
+    """Параметр пути, совпадающий только с известными префиксами сервисов"""
+    regex = "|".join(re.escape(prefix) for prefix in SERVICE_MAP)
+    
+    def convert(self, value: str) -> str:
+        return value
+    
+    def to_string(self, value: str) -> str:
+        return value
+
+register_url_convertor("service", ServicePrefixConvertor())
+
+# Маршрут совпадает только с префиксами из SERVICE_MAP, поэтому запросы
+# к явным маршрутам (/api/auth/*) с другим методом получают 405, а не 404
+@app.api_route("/api/{service:service}/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+async def proxy_service(request: Request, service: str, path: str):
+    """Проксирование запросов к сервису по префиксу пути"""
+    return await proxy_request(SERVICE_MAP[service], request, path)
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
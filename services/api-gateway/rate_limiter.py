@@ -2,9 +2,10 @@
 Rate Limiter для API Gateway
 Ограничение скорости запросов для предотвращения злоупотреблений
 """
+import heapq
+import threading
 import time
-from typing import Dict, Optional
-from collections import defaultdict, deque
+from typing import Dict, List, Optional, Set, Tuple
 import logging
 from dataclasses import dataclass
 
@@ -12,60 +13,170 @@ from utils.logger import get_logger
 
 logger = get_logger("rate-limiter")
 
+# Число ячеек колеса таймеров; колесо охватывает два окна
+WHEEL_SIZE = 64
+# Число шардов состояния (степень двойки для выбора шарда маской)
+SHARD_COUNT = 16
+
+def _shift_window(counters: Optional[Tuple[int, int, int]], window: int) -> Tuple[int, int, int]:
+    """Сдвиг счетчиков (текущее, предыдущее, номер окна) к окну window"""
+    if counters is None:
+        return 0, 0, window
+    
+    current, previous, start = counters
+    if start == window:
+        return counters
+    if start == window - 1:
+        return 0, current, window
+    # Пропущено больше одного окна
+    return 0, 0, window
+
 @dataclass
 class RateLimitConfig:
     """Конфигурация ограничения скорости"""
     requests_per_minute: int
     burst_limit: int = 10
     window_size: int = 60  # секунды
+    
+    @property
+    def refill_rate(self) -> float:
+        """Скорость пополнения token bucket (токенов в секунду)"""
+        return self.requests_per_minute / 60.0
+    
+    @property
+    def capacity(self) -> int:
+        """Емкость token bucket (допустимый всплеск)"""
+        return self.burst_limit
+
+class _IPState:
+    """Состояние IP: token bucket и счетчики скользящего окна в одном объекте"""
+    
+    __slots__ = ("tokens", "last_refill", "current", "previous", "window")
+    
+    def __init__(self, tokens: float, last_refill: float, current: int, previous: int, window: int):
+        self.tokens = tokens
+        self.last_refill = last_refill
+        self.current = current
+        self.previous = previous
+        self.window = window
+
+class _Shard:
+    """Состояние rate limiter для подмножества IP с собственной блокировкой"""
+    
+    __slots__ = ("ips", "blocked_ips", "block_heap", "wheel", "wheel_tick", "total_window", "lock")
+    
+    def __init__(self, wheel_tick: int):
+        # Состояние IP: одно обращение к словарю на запрос
+        self.ips: Dict[str, _IPState] = {}
+        self.blocked_ips: Dict[str, float] = {}
+        # Min-куча (время окончания блокировки, IP) с ленивым удалением устаревших записей
+        self.block_heap: List[Tuple[float, str]] = []
+        # Колесо таймеров: в каждой ячейке IP, записи которых нужно проверить на истечение
+        self.wheel: List[Set[str]] = [set() for _ in range(WHEEL_SIZE)]
+        self.wheel_tick = wheel_tick
+        # Счетчики окна по всем IP шарда для статистики
+        self.total_window: Tuple[int, int, int] = (0, 0, 0)
+        self.lock = threading.Lock()
+    
+    def clear(self):
+        self.ips.clear()
+        self.blocked_ips.clear()
+        self.block_heap.clear()
+        for slot in self.wheel:
+            slot.clear()
+        self.total_window = (0, 0, 0)
 
 class RateLimiter:
-    """Ограничитель скорости запросов"""
+    """Ограничитель скорости запросов
+    
+    Все внутренние отметки времени (окна, блокировки) берутся из time.monotonic()
+    и не зависят от корректировок системных часов; наружу (get_reset_time)
+    время отдается по системным часам.
+    Состояние разбито на SHARD_COUNT шардов по хэшу IP: каждый шард
+    защищен своей блокировкой и очищается независимо от остальных.
+    """
     
     def __init__(self, requests_per_minute: int):
         self.config = RateLimitConfig(requests_per_minute)
-        self.requests: Dict[str, deque] = defaultdict(deque)
-        self.blocked_ips: Dict[str, float] = {}
         self.block_duration = 300  # 5 минут блокировки
+        wheel_tick = self._tick(time.monotonic())
+        self._shards = [_Shard(wheel_tick) for _ in range(SHARD_COUNT)]
         
         logger.info(f"Rate limiter initialized: {requests_per_minute} requests per minute")
     
     def is_allowed(self, client_ip: str) -> bool:
         """Проверка разрешения запроса"""
         try:
-            current_time = time.time()
+            current_time = time.monotonic()
+            shard = self._shard(client_ip)
             
-            # Проверка блокировки IP
-            if client_ip in self.blocked_ips:
-                if current_time < self.blocked_ips[client_ip]:
-                    logger.warning(f"Blocked IP attempted request: {client_ip}")
+            with shard.lock:
+                # Проверка истечения записей, срок которых подошел
+                if self._tick(current_time) != shard.wheel_tick:
+                    self._advance_wheel(shard, current_time)
+                
+                # Проверка блокировки IP
+                block_time = shard.blocked_ips.get(client_ip)
+                if block_time is not None:
+                    if current_time < block_time:
+                        logger.warning(f"Blocked IP attempted request: {client_ip}")
+                        return False
+                    # Блокировка истекла
+                    del shard.blocked_ips[client_ip]
+                
+                # Параметры конфигурации читаются один раз за вызов
+                config = self.config
+                window_size = config.window_size
+                capacity = config.burst_limit
+                
+                # Получение состояния IP: счетчики окна и токены
+                window = int(current_time // window_size)
+                state = shard.ips.get(client_ip)
+                if state is None:
+                    current = previous = 0
+                    tokens = capacity
+                else:
+                    current = state.current
+                    previous = state.previous
+                    start = state.window
+                    if start != window:
+                        # Сдвиг к текущему окну; пропуск больше одного окна обнуляет счетчики
+                        previous = current if start == window - 1 else 0
+                        current = 0
+                    tokens = min(capacity, state.tokens + (current_time - state.last_refill) * config.refill_rate)
+                
+                # Проверка лимита (оценка скользящего окна)
+                estimated = previous * (1 - (current_time % window_size) / window_size) + current
+                if estimated >= config.requests_per_minute:
+                    # Превышен лимит - блокировка IP
+                    block_duration = self.block_duration
+                    block_time = current_time + block_duration
+                    shard.blocked_ips[client_ip] = block_time
+                    heapq.heappush(shard.block_heap, (block_time, client_ip))
+                    logger.warning(f"Rate limit exceeded for IP: {client_ip}, blocked for {block_duration} seconds")
+                    return False
+                
+                # Проверка burst лимита (token bucket)
+                if tokens < 1:
+                    # Состояние не меняется: пополнение однозначно следует из сохраненного
+                    logger.warning(f"Burst limit exceeded for IP: {client_ip}")
                     return False
+                
+                # Запрос разрешен - списание токена и учет в текущем окне
+                if state is None:
+                    shard.ips[client_ip] = _IPState(tokens - 1, current_time, current + 1, previous, window)
                 else:
-                    # Блокировка истекла
-                    del self.blocked_ips[client_ip]
-            
-            # Получение истории запросов для IP
-            request_times = self.requests[client_ip]
-            
-            # Удаление старых запросов (старше окна)
-            while request_times and current_time - request_times[0] > self.config.window_size:
-                request_times.popleft()
-            
-            # Проверка лимита
-            if len(request_times) >= self.config.requests_per_minute:
-                # Превышен лимит - блокировка IP
-                self.blocked_ips[client_ip] = current_time + self.block_duration
-                logger.warning(f"Rate limit exceeded for IP: {client_ip}, blocked for {self.block_duration} seconds")
-                return False
-            
-            # Проверка burst лимита
-            recent_requests = sum(1 for req_time in request_times if current_time - req_time < 10)
-            if recent_requests >= self.config.burst_limit:
-                logger.warning(f"Burst limit exceeded for IP: {client_ip}")
-                return False
-            
-            # Запрос разрешен - добавление времени запроса
-            request_times.append(current_time)
+                    state.tokens = tokens - 1
+                    state.last_refill = current_time
+                    state.current = current + 1
+                    state.previous = previous
+                    state.window = window
+                if not current:
+                    # Первый запрос в окне: запись устареет через два окна
+                    self._schedule(shard, client_ip, (window + 2) * window_size)
+                
+                total_current, total_previous, _ = _shift_window(shard.total_window, window)
+                shard.total_window = (total_current + 1, total_previous, window)
             
             return True
             
@@ -73,36 +184,133 @@ class RateLimiter:
             logger.error(f"Rate limiter error for IP {client_ip}: {e}")
             return True  # В случае ошибки разрешаем запрос
     
+    def _shard(self, client_ip: str) -> _Shard:
+        """Шард, хранящий состояние IP"""
+        return self._shards[hash(client_ip) & (SHARD_COUNT - 1)]
+    
+    def _current_window(self, shard: _Shard, client_ip: str, current_time: float) -> Tuple[int, int, int]:
+        """Счетчики окна IP, сдвинутые к окну, содержащему current_time"""
+        window = int(current_time // self.config.window_size)
+        state = shard.ips.get(client_ip)
+        if state is None:
+            return 0, 0, window
+        return _shift_window((state.current, state.previous, state.window), window)
+    
+    def _estimate_requests(self, counters: Tuple[int, int, int], current_time: float) -> float:
+        """Оценка числа запросов за последние window_size секунд (приближение скользящего окна)"""
+        current, previous, _ = counters
+        window_size = self.config.window_size
+        return previous * (1 - (current_time % window_size) / window_size) + current
+    
+    def _refill_tokens(self, shard: _Shard, client_ip: str, current_time: float) -> float:
+        """Количество токенов IP на момент current_time (без сохранения)"""
+        capacity = self.config.capacity
+        state = shard.ips.get(client_ip)
+        if state is None:
+            return capacity
+        
+        return min(capacity, state.tokens + (current_time - state.last_refill) * self.config.refill_rate)
+    
+    def _tick(self, current_time: float) -> int:
+        """Номер такта колеса таймеров"""
+        return int(current_time * WHEEL_SIZE // (2 * self.config.window_size))
+    
+    def _schedule(self, shard: _Shard, client_ip: str, expiry: float):
+        """Постановка IP в ячейку колеса шарда, соответствующую времени expiry"""
+        shard.wheel[(self._tick(expiry) + 1) % WHEEL_SIZE].add(client_ip)
+    
+    def _advance_wheel(self, shard: _Shard, current_time: float) -> int:
+        """Проверка ячеек колеса шарда, срок которых наступил (под блокировкой шарда)"""
+        tick = self._tick(current_time)
+        
+        # Блокировки длиннее оборота колеса, поэтому истекают через кучу
+        expired = 0
+        block_heap = shard.block_heap
+        while block_heap and block_heap[0][0] <= current_time:
+            block_time, ip = heapq.heappop(block_heap)
+            # Запись могла быть снята или заменена новой блокировкой
+            if shard.blocked_ips.get(ip) == block_time:
+                del shard.blocked_ips[ip]
+                expired += 1
+        
+        for step in range(min(tick - shard.wheel_tick, WHEEL_SIZE)):
+            slot = (shard.wheel_tick + 1 + step) % WHEEL_SIZE
+            due_ips = shard.wheel[slot]
+            shard.wheel[slot] = set()
+            
+            for ip in due_ips:
+                next_check = self._expire_ip(shard, ip, current_time)
+                if next_check is None:
+                    expired += 1
+                else:
+                    self._schedule(shard, ip, next_check)
+        
+        shard.wheel_tick = tick
+        return expired
+    
+    def _expire_ip(self, shard: _Shard, client_ip: str, current_time: float) -> Optional[float]:
+        """Удаление истекшего состояния IP; возвращает время следующей проверки или None"""
+        state = shard.ips.get(client_ip)
+        if state is None:
+            return None
+        
+        # Состояние не нужно, когда окна устарели и bucket полностью пополнен
+        stale_at = (state.window + 2) * self.config.window_size
+        refill_rate = self.config.refill_rate
+        if refill_rate > 0:
+            full_at = state.last_refill + (self.config.capacity - state.tokens) / refill_rate
+            next_check = max(stale_at, full_at)
+        else:
+            # Лимит 0 запросов: bucket не пополняется, запросы отклоняет окно
+            next_check = stale_at
+        if next_check <= current_time:
+            del shard.ips[client_ip]
+            return None
+        return next_check
+    
     def get_remaining_requests(self, client_ip: str) -> int:
         """Получение количества оставшихся запросов"""
         try:
-            current_time = time.time()
-            request_times = self.requests[client_ip]
+            current_time = time.monotonic()
+            shard = self._shard(client_ip)
             
-            # Удаление старых запросов
-            while request_times and current_time - request_times[0] > self.config.window_size:
-                request_times.popleft()
+            with shard.lock:
+                counters = self._current_window(shard, client_ip, current_time)
+                tokens = self._refill_tokens(shard, client_ip, current_time)
             
-            remaining = max(0, self.config.requests_per_minute - len(request_times))
-            return remaining
+            estimated = self._estimate_requests(counters, current_time)
+            remaining = max(0, int(self.config.requests_per_minute - estimated))
+            # Не больше, чем позволяет текущий запас токенов
+            return min(remaining, int(tokens))
             
         except Exception as e:
             logger.error(f"Error getting remaining requests for IP {client_ip}: {e}")
             return self.config.requests_per_minute
     
     def get_reset_time(self, client_ip: str) -> Optional[float]:
-        """Получение времени сброса лимита"""
+        """Получение времени сброса лимита (Unix timestamp, по time.time())"""
         try:
-            if client_ip in self.blocked_ips:
-                return self.blocked_ips[client_ip]
+            current_time = time.monotonic()
+            shard = self._shard(client_ip)
             
-            request_times = self.requests[client_ip]
-            if not request_times:
+            with shard.lock:
+                block_time = shard.blocked_ips.get(client_ip)
+                tokens = self._refill_tokens(shard, client_ip, current_time)
+                current, previous, window = self._current_window(shard, client_ip, current_time)
+            
+            if block_time is not None:
+                reset_time = block_time
+            elif tokens < 1 and self.config.refill_rate > 0:
+                # Исчерпан burst лимит - сброс при появлении следующего токена
+                reset_time = current_time + (1 - tokens) / self.config.refill_rate
+            elif current or previous:
+                # Запросы текущего окна учитываются до конца следующего окна
+                reset_time = (window + (2 if current else 1)) * self.config.window_size
+            else:
                 return None
             
-            # Время самого старого запроса + окно
-            oldest_request = request_times[0]
-            return oldest_request + self.config.window_size
+            # Перевод из шкалы time.monotonic() в системное время для клиентов
+            return time.time() + (reset_time - current_time)
             
         except Exception as e:
             logger.error(f"Error getting reset time for IP {client_ip}: {e}")
@@ -110,22 +318,28 @@ class RateLimiter:
     
     def is_blocked(self, client_ip: str) -> bool:
         """Проверка блокировки IP"""
-        if client_ip not in self.blocked_ips:
-            return False
+        shard = self._shard(client_ip)
         
-        current_time = time.time()
-        if current_time >= self.blocked_ips[client_ip]:
-            # Блокировка истекла
-            del self.blocked_ips[client_ip]
-            return False
+        with shard.lock:
+            block_time = shard.blocked_ips.get(client_ip)
+            if block_time is None:
+                return False
+            
+            if time.monotonic() >= block_time:
+                # Блокировка истекла
+                del shard.blocked_ips[client_ip]
+                return False
         
         return True
     
     def unblock_ip(self, client_ip: str) -> bool:
         """Разблокировка IP"""
         try:
-            if client_ip in self.blocked_ips:
-                del self.blocked_ips[client_ip]
+            shard = self._shard(client_ip)
+            with shard.lock:
+                unblocked = shard.blocked_ips.pop(client_ip, None) is not None
+            
+            if unblocked:
                 logger.info(f"IP unblocked: {client_ip}")
                 return True
             return False
@@ -137,8 +351,11 @@ class RateLimiter:
     def clear_ip_history(self, client_ip: str) -> bool:
         """Очистка истории запросов для IP"""
         try:
-            if client_ip in self.requests:
-                del self.requests[client_ip]
+            shard = self._shard(client_ip)
+            with shard.lock:
+                cleared = shard.ips.pop(client_ip, None) is not None
+            
+            if cleared:
                 logger.info(f"Request history cleared for IP: {client_ip}")
                 return True
             return False
@@ -150,31 +367,33 @@ class RateLimiter:
     def get_stats(self) -> Dict[str, any]:
         """Получение статистики rate limiter"""
         try:
-            current_time = time.time()
+            current_time = time.monotonic()
             
-            # Подсчет активных IP
+            # Счетчики поддерживаются при изменениях, истекшие записи удаляет колесо таймеров
+            window = int(current_time // self.config.window_size)
             active_ips = 0
-            total_requests = 0
+            blocked_ips = 0
+            total_current = 0
+            total_previous = 0
             
-            for ip, request_times in self.requests.items():
-                # Удаление старых запросов
-                while request_times and current_time - request_times[0] > self.config.window_size:
-                    request_times.popleft()
-                
-                if request_times:
-                    active_ips += 1
-                    total_requests += len(request_times)
+            for shard in self._shards:
+                with shard.lock:
+                    # Шарды без трафика продвигаются здесь
+                    self._advance_wheel(shard, current_time)
+                    active_ips += len(shard.ips)
+                    blocked_ips += len(shard.blocked_ips)
+                    total_window = shard.total_window
+                current, previous, _ = _shift_window(total_window, window)
+                total_current += current
+                total_previous += previous
             
-            # Подсчет заблокированных IP
-            blocked_ips = 0
-            for block_time in self.blocked_ips.values():
-                if current_time < block_time:
-                    blocked_ips += 1
+            # Счетчики шардов суммируются, оценка окна вычисляется один раз
+            total_requests = self._estimate_requests((total_current, total_previous, window), current_time)
             
             return {
                 "active_ips": active_ips,
                 "blocked_ips": blocked_ips,
-                "total_requests": total_requests,
+                "total_requests": round(total_requests),
                 "requests_per_minute_limit": self.config.requests_per_minute,
                 "burst_limit": self.config.burst_limit,
                 "window_size": self.config.window_size,
@@ -188,28 +407,16 @@ class RateLimiter:
     def cleanup_expired_entries(self):
         """Очистка истекших записей"""
         try:
-            current_time = time.time()
-            
-            # Очистка истекших блокировок
-            expired_blocks = [
-                ip for ip, block_time in self.blocked_ips.items()
-                if current_time >= block_time
-            ]
+            current_time = time.monotonic()
             
-            for ip in expired_blocks:
-                del self.blocked_ips[ip]
-            
-            # Очистка старых запросов
-            for ip, request_times in self.requests.items():
-                while request_times and current_time - request_times[0] > self.config.window_size:
-                    request_times.popleft()
-                
-                # Удаление пустых записей
-                if not request_times:
-                    del self.requests[ip]
+            # Шарды очищаются по очереди, каждый под своей блокировкой
+            expired = 0
+            for shard in self._shards:
+                with shard.lock:
+                    expired += self._advance_wheel(shard, current_time)
             
-            if expired_blocks:
-                logger.info(f"Cleaned up {len(expired_blocks)} expired block entries")
+            if expired:
+                logger.debug(f"Cleaned up {expired} expired rate limiter entries")
                 
         except Exception as e:
             logger.error(f"Error during cleanup: {e}")
@@ -224,6 +431,11 @@ class RateLimiter:
             
             if window_size is not None:
                 self.config.window_size = window_size
+                # Длительность такта колеса зависит от окна
+                wheel_tick = self._tick(time.monotonic())
+                for shard in self._shards:
+                    with shard.lock:
+                        shard.wheel_tick = wheel_tick
             
             logger.info(f"Rate limiter config updated: {requests_per_minute} req/min, burst: {self.config.burst_limit}, window: {self.config.window_size}s")
             
@@ -233,8 +445,9 @@ class RateLimiter:
     def reset_all(self):
         """Сброс всех данных"""
         try:
-            self.requests.clear()
-            self.blocked_ips.clear()
+            for shard in self._shards:
+                with shard.lock:
+                    shard.clear()
             logger.info("Rate limiter data reset")
             
         except Exception as e:
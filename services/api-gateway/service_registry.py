@@ -3,18 +3,24 @@
 Управление регистрацией и обнаружением сервисов
 """
 import asyncio
+import random
+import sys
 import time
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Set
 import logging
 import httpx
-from dataclasses import dataclass, asdict
+import orjson
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 
 from utils.logger import get_logger
 
 logger = get_logger("service-registry")
 
-@dataclass
+# Тело ответа /health разбирается только если оно не больше этого размера (байт)
+HEALTH_BODY_PARSE_LIMIT = 256
+
+@dataclass(slots=True)
 class ServiceInfo:
     """Информация о сервисе"""
     name: str
@@ -25,16 +31,50 @@ class ServiceInfo:
     is_healthy: bool
     response_time: Optional[float]
     metadata: Dict[str, Any]
+    # Сериализованное представление, сбрасывается при изменении состояния
+    _cached_dict: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False, compare=False)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Представление сервиса для JSON (кэшируется, изменять нельзя)"""
+        info = self._cached_dict
+        if info is None:
+            info = self._cached_dict = {
+                "name": self.name,
+                "url": self.url,
+                "health_url": self.health_url,
+                "registered_at": self.registered_at.isoformat(),
+                "last_health_check": self.last_health_check.isoformat() if self.last_health_check else None,
+                "is_healthy": self.is_healthy,
+                "response_time": self.response_time,
+                "metadata": self.metadata
+            }
+        return info
 
 class ServiceRegistry:
     """Реестр сервисов"""
     
     def __init__(self):
         self.services: Dict[str, ServiceInfo] = {}
+        # Маршруты по целочисленному id: URL и здоровье в параллельных списках
+        self._name_to_id: Dict[str, int] = {}
+        self._urls: List[Optional[str]] = []
+        self._healthy: List[bool] = []
+        # JSON списка сервисов, сбрасывается при любом изменении реестра
+        self._services_json_cache: Optional[bytes] = None
         self.health_check_interval = 30  # секунды
         self.health_check_timeout = 10  # секунды
+        # Задача мониторинга (TaskGroup) и дочерние задачи проверки по сервисам
         self.health_check_task: Optional[asyncio.Task] = None
+        self._probe_tasks: Dict[str, asyncio.Task] = {}
+        # Очередь сервисов, для которых нужно запустить проверку
+        self._probe_queue: Optional[asyncio.Queue] = None
+        # Ограничение числа одновременных проверок
+        self._probe_sem = asyncio.Semaphore(16)
         self.is_running = False
+        # Общий HTTP клиент для проверок здоровья (keep-alive между проверками)
+        self._client: Optional[httpx.AsyncClient] = None
+        # URL проверок здоровья, не поддерживающие HEAD
+        self._head_unsupported: Set[str] = set()
         
         logger.info("Service registry initialized")
     
@@ -65,12 +105,24 @@ class ServiceRegistry:
             
             # Регистрация сервиса
             self.services[name] = service_info
+            self._services_json_cache = None
+            
+            route_id = self._name_to_id.get(name)
+            if route_id is None:
+                route_id = self._name_to_id[sys.intern(name)] = len(self._urls)
+                self._urls.append(url)
+                self._healthy.append(is_healthy)
+            else:
+                self._urls[route_id] = url
+                self._healthy[route_id] = is_healthy
             
             logger.info(f"Service registered: {name} at {url} (healthy: {is_healthy})")
             
             # Запуск мониторинга здоровья, если еще не запущен
             if not self.is_running:
                 await self.start_health_monitoring()
+            elif name not in self._probe_tasks:
+                self._start_probe(name)
             
             return True
             
@@ -83,6 +135,14 @@ class ServiceRegistry:
         try:
             if name in self.services:
                 del self.services[name]
+                self._services_json_cache = None
+                # id сохраняется за именем до повторной регистрации
+                route_id = self._name_to_id[name]
+                self._urls[route_id] = None
+                self._healthy[route_id] = False
+                task = self._probe_tasks.pop(name, None)
+                if task:
+                    task.cancel()
                 logger.info(f"Service unregistered: {name}")
                 return True
             else:
@@ -95,33 +155,35 @@ class ServiceRegistry:
     
     async def get_service_url(self, name: str) -> Optional[str]:
         """Получение URL сервиса"""
-        if name in self.services and self.services[name].is_healthy:
-            return self.services[name].url
-        return None
+        route_id = self._name_to_id.get(name)
+        if route_id is None:
+            return None
+        return self.get_route_url(route_id)
+    
+    def get_route_id(self, name: str) -> Optional[int]:
+        """Получение целочисленного id маршрута сервиса (постоянен для имени)"""
+        return self._name_to_id.get(name)
+    
+    def get_route_url(self, route_id: int) -> Optional[str]:
+        """Получение URL здорового сервиса по id маршрута"""
+        return self._urls[route_id] if self._healthy[route_id] else None
     
     async def get_service_info(self, name: str) -> Optional[Dict[str, Any]]:
         """Получение информации о сервисе"""
-        if name in self.services:
-            service = self.services[name]
-            info = asdict(service)
-            # Конвертация datetime в строки
-            for key, value in info.items():
-                if isinstance(value, datetime):
-                    info[key] = value.isoformat()
-            return info
+        service = self.services.get(name)
+        if service is not None:
+            return service.to_dict()
         return None
     
     def get_all_services(self) -> List[Dict[str, Any]]:
         """Получение информации о всех сервисах"""
-        services = []
-        for service in self.services.values():
-            info = asdict(service)
-            # Конвертация datetime в строки
-            for key, value in info.items():
-                if isinstance(value, datetime):
-                    info[key] = value.isoformat()
-            services.append(info)
-        return services
+        return [service.to_dict() for service in self.services.values()]
+    
+    def get_all_services_json(self) -> bytes:
+        """Информация о всех сервисах в виде готового JSON"""
+        if self._services_json_cache is None:
+            self._services_json_cache = orjson.dumps(self.get_all_services())
+        return self._services_json_cache
     
     def get_registered_services(self) -> List[str]:
         """Получение списка зарегистрированных сервисов"""
@@ -133,27 +195,55 @@ class ServiceRegistry:
             return self.services[name].is_healthy
         return False
     
+    def _get_client(self) -> httpx.AsyncClient:
+        """Получение общего HTTP клиента (создается при первом использовании)"""
+        if self._client is None or self._client.is_closed:
+            # Проверки сервисов за одним (scheme, host, port) переиспользуют
+            # keep-alive соединение общего пула. http2=True действует только для
+            # https:// бэкендов: httpx не поддерживает HTTP/2 без TLS (h2c), поэтому
+            # для текущих http:// сервисов флаг ничего не меняет
+            self._client = httpx.AsyncClient(
+                http2=True,
+                timeout=self.health_check_timeout,
+                limits=httpx.Limits(max_keepalive_connections=64)
+            )
+        return self._client
+    
     async def _check_service_health(self, health_url: str) -> bool:
         """Проверка здоровья сервиса"""
         try:
-            start_time = time.time()
+            start_time = time.monotonic()
+            
+            client = self._get_client()
             
-            async with httpx.AsyncClient(timeout=self.health_check_timeout) as client:
+            # HEAD не передает тело; при 405 сервис запоминается и проверяется через GET
+            response = None
+            if health_url not in self._head_unsupported:
+                response = await client.head(health_url)
+                if response.status_code == 405:
+                    self._head_unsupported.add(health_url)
+                    response = None
+            if response is None:
                 response = await client.get(health_url)
+            
+            response_time = time.monotonic() - start_time
+            
+            if response.status_code == 200:
+                # Статус из тела проверяется только для коротких JSON ответов
+                content_type = response.headers.get("content-type", "")
+                content = response.content
+                if not content or not content_type.startswith("application/json") or len(content) > HEALTH_BODY_PARSE_LIMIT:
+                    return True
                 
-                response_time = time.time() - start_time
+                try:
+                    data = orjson.loads(content)
+                    is_healthy = data.get("status") == "healthy"
+                except:
+                    is_healthy = True  # Если не JSON, считаем здоровым при 200
                 
-                if response.status_code == 200:
-                    # Проверка содержимого ответа
-                    try:
-                        data = response.json()
-                        is_healthy = data.get("status") == "healthy"
-                    except:
-                        is_healthy = True  # Если не JSON, считаем здоровым при 200
-                    
-                    return is_healthy
-                else:
-                    return False
+                return is_healthy
+            else:
+                return False
                     
         except Exception as e:
             logger.debug(f"Health check failed for {health_url}: {e}")
@@ -162,14 +252,17 @@ class ServiceRegistry:
     async def _update_service_health(self, name: str, service_info: ServiceInfo):
         """Обновление информации о здоровье сервиса"""
         try:
-            start_time = time.time()
+            start_time = time.monotonic()
             is_healthy = await self._check_service_health(service_info.health_url)
-            response_time = time.time() - start_time
+            response_time = time.monotonic() - start_time
             
             # Обновление информации
             service_info.last_health_check = datetime.now()
             service_info.is_healthy = is_healthy
             service_info.response_time = response_time if is_healthy else None
+            service_info._cached_dict = None
+            self._services_json_cache = None
+            self._set_route_health(name, service_info, is_healthy)
             
             if is_healthy:
                 logger.debug(f"Service {name} is healthy (response time: {response_time:.3f}s)")
@@ -180,6 +273,14 @@ class ServiceRegistry:
             logger.error(f"Error updating health for service {name}: {e}")
             service_info.is_healthy = False
             service_info.last_health_check = datetime.now()
+            service_info._cached_dict = None
+            self._services_json_cache = None
+            self._set_route_health(name, service_info, False)
+    
+    def _set_route_health(self, name: str, service_info: ServiceInfo, is_healthy: bool):
+        """Синхронизация здоровья в таблице маршрутов (если сервис не перерегистрирован)"""
+        if self.services.get(name) is service_info:
+            self._healthy[self._name_to_id[name]] = is_healthy
     
     async def start_health_monitoring(self):
         """Запуск мониторинга здоровья сервисов"""
@@ -187,6 +288,9 @@ class ServiceRegistry:
             return
         
         self.is_running = True
+        self._probe_queue = asyncio.Queue()
+        for name in self.services:
+            self._start_probe(name)
         self.health_check_task = asyncio.create_task(self._health_monitoring_loop())
         logger.info("Health monitoring started")
     
@@ -198,35 +302,52 @@ class ServiceRegistry:
         self.is_running = False
         
         if self.health_check_task:
+            # Отмена задачи мониторинга отменяет все дочерние проверки TaskGroup
             self.health_check_task.cancel()
             try:
                 await self.health_check_task
             except asyncio.CancelledError:
                 pass
+            self.health_check_task = None
+        self._probe_tasks.clear()
         
         logger.info("Health monitoring stopped")
     
+    def _start_probe(self, name: str):
+        """Постановка сервиса в очередь на запуск проверки здоровья"""
+        self._probe_queue.put_nowait(name)
+    
     async def _health_monitoring_loop(self):
-        """Основной цикл мониторинга здоровья"""
-        while self.is_running:
-            try:
-                # Проверка здоровья всех сервисов
-                tasks = []
-                for name, service_info in self.services.items():
-                    task = self._update_service_health(name, service_info)
-                    tasks.append(task)
-                
-                if tasks:
-                    await asyncio.gather(*tasks, return_exceptions=True)
-                
-                # Ожидание до следующей проверки
-                await asyncio.sleep(self.health_check_interval)
+        """Основной цикл мониторинга: отдельная дочерняя задача на каждый сервис"""
+        async with asyncio.TaskGroup() as task_group:
+            while self.is_running:
+                name = await self._probe_queue.get()
+                if name in self.services and name not in self._probe_tasks:
+                    self._probe_tasks[name] = task_group.create_task(self._probe_loop(name))
+    
+    async def _probe_loop(self, name: str):
+        """Цикл проверки здоровья одного сервиса"""
+        try:
+            # Сдвиг фазы по имени сервиса: проверки распределены по интервалу, а не идут пачкой
+            await asyncio.sleep(hash(name) % self.health_check_interval)
+            
+            while self.is_running:
+                try:
+                    service_info = self.services.get(name)
+                    if service_info is None:
+                        return
+                    
+                    async with self._probe_sem:
+                        await self._update_service_health(name, service_info)
+                    
+                except Exception as e:
+                    logger.error(f"Health monitoring loop error for {name}: {e}")
                 
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                logger.error(f"Health monitoring loop error: {e}")
-                await asyncio.sleep(self.health_check_interval)
+                # Ожидание до следующей проверки с небольшим случайным разбросом
+                await asyncio.sleep(self.health_check_interval * (1 + random.random() * 0.1))
+        finally:
+            if self._probe_tasks.get(name) is asyncio.current_task():
+                del self._probe_tasks[name]
     
     async def get_healthy_services(self) -> List[str]:
         """Получение списка здоровых сервисов"""
@@ -268,6 +389,15 @@ class ServiceRegistry:
         try:
             await self.stop_health_monitoring()
             self.services.clear()
+            # id маршрутов остаются за именами: их кэширует балансировщик
+            for route_id in range(len(self._urls)):
+                self._urls[route_id] = None
+                self._healthy[route_id] = False
+            self._services_json_cache = None
+            
+            if self._client:
+                await self._client.aclose()
+                self._client = None
             logger.info("Service registry cleanup completed")
             
         except Exception as e:
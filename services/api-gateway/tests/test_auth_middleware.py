@@ -0,0 +1,80 @@
+"""
+Тесты проверки JWT токенов в AuthMiddleware
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("jwt")
+pytest.importorskip("passlib")
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent.parent.parent / "shared"))
+
+from auth_middleware import AuthMiddleware, SecurityConfig
+
+
+@pytest.fixture(scope="module")
+def auth():
+    return AuthMiddleware(SecurityConfig(
+        secret_key="test-secret",
+        jwt_expire_hours=1,
+        allowed_origins=("*",),
+        rate_limit_per_minute=60
+    ))
+
+
+def test_valid_token(auth):
+    token = auth.create_access_token({"sub": "admin"})
+    assert auth.verify_token(token)["sub"] == "admin"
+
+
+@pytest.mark.parametrize("suffix", [".!!*$", "!!", "*", "=", "."])
+def test_tampered_signature_rejected(auth, suffix):
+    token = auth.create_access_token({"sub": "admin"})
+    assert auth.verify_token(token + suffix) is None
+
+
+def test_wrong_secret_rejected(auth):
+    other = AuthMiddleware(SecurityConfig(
+        secret_key="other-secret",
+        jwt_expire_hours=1,
+        allowed_origins=("*",),
+        rate_limit_per_minute=60
+    ))
+    assert auth.verify_token(other.create_access_token({"sub": "admin"})) is None
+
+
+def test_check_permission_with_public_view(auth):
+    user = auth.get_all_users()["user"]
+    assert auth.check_permission(user, "read")
+    assert not auth.check_permission(user, "write")
+    assert auth.check_permission(auth.get_all_users()["admin"], "write")
+
+
+def test_concurrent_logins_share_verification_cache(auth):
+    import asyncio
+    
+    async def login_many():
+        return await asyncio.gather(*(
+            auth.authenticate_user("user" if i % 2 else "admin", "user123" if i % 2 else "admin123")
+            for i in range(32)
+        ))
+    
+    cache_size = auth.verify_cache_size
+    auth.verify_cache_size = 2
+    try:
+        results = asyncio.run(login_many())
+    finally:
+        auth.verify_cache_size = cache_size
+    
+    assert all(result["success"] for result in results)
+    assert len(auth._verify_cache) <= 2
+
+
+def test_check_permission_uses_passed_permissions(auth):
+    admin = auth.get_all_users()["admin"]
+    scoped = {**admin, "permissions": ("read",)}
+    assert not auth.check_permission(scoped, "write")
+    assert not auth.check_permission({"username": "admin", "permissions": ["read"]}, "write")
@@ -1,54 +1,200 @@
 """
 WebSocket менеджер для API Gateway
 Управление WebSocket соединениями и маршрутизация сообщений
+
+Рассчитан на работу в цикле событий uvloop: uvicorn[standard] устанавливает
+uvloop и выбирает его сам (--loop auto, либо явно --loop uvloop).
 """
 import asyncio
-import json
 import logging
-from typing import Dict, List, Set, Any
-from fastapi import WebSocket
-from collections import defaultdict
+import time
+import zlib
+from typing import Deque, Dict, List, Optional, Set, Any, Tuple, Union
+from fastapi import WebSocket, WebSocketDisconnect
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass, field
+import msgpack
+import orjson
 
 from utils.logger import get_logger
 
 logger = get_logger("gateway-websocket-manager")
 
+# Подпротокол, при котором сообщения передаются бинарными кадрами MessagePack
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+# Подпротокол, при котором JSON сообщения сжимаются zlib на уровне приложения.
+# Бинарный кадр начинается с байта формата: 0x00 - несжатый JSON, 0x01 - zlib.
+ZLIB_SUBPROTOCOL = "json.zlib"
+ZLIB_RAW_FLAG = b"\x00"
+ZLIB_COMPRESSED_FLAG = b"\x01"
+
+# Атрибут WebSocket объекта, в котором хранится ConnInfo соединения
+# (доступ к атрибуту дешевле поиска в словаре на каждом сообщении)
+CONN_STATE_ATTR = "_gateway_conn"
+
+# Номера форматов соединения (индекс в кэше сериализованных сообщений рассылки)
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+CODEC_ZLIB = 2
+
+# Максимальное число сообщений, объединяемых в один кадр
+MAX_SEND_BATCH = 256
+
+# Параметр запроса (?batch=1), которым клиент соглашается получать пачки
+# {"type": "batch", "items": [...]}; остальным сообщения уходят по одному на кадр
+BATCH_QUERY_PARAM = "batch"
+
+# Размер очередей соединения и порог предупреждения о заполнении
+QUEUE_MAX_SIZE = 1024
+QUEUE_WARNING_SIZE = int(QUEUE_MAX_SIZE * 0.8)
+
+# Заголовок пачки {"type": "batch", "items": [...]} в MessagePack без массива
+_MSGPACK_BATCH_PREFIX = b"\x82" + msgpack.packb("type") + msgpack.packb("batch") + msgpack.packb("items")
+_msgpack_packer = msgpack.Packer(use_bin_type=True)
+
+# Заготовки ответа {"type": "pong", "timestamp": ...}; дописывается только время
+_PONG_JSON_PREFIX = '{"type":"pong","timestamp":'
+_PONG_MSGPACK_PREFIX = b"\x82" + msgpack.packb("type") + msgpack.packb("pong") + msgpack.packb("timestamp")
+
+# Ожидаемые ошибки отправки в закрытое соединение: Starlette бросает RuntimeError
+# после закрытия, uvicorn оборачивает ConnectionClosed в ClientDisconnected (OSError)
+_SEND_ERRORS = (WebSocketDisconnect, RuntimeError, OSError)
+
+# Ошибки сериализации orjson (JSONEncodeError - подкласс TypeError) и msgpack
+_ENCODE_ERRORS = (TypeError, ValueError, OverflowError)
+
+@dataclass(slots=True)
+class ConnInfo:
+    """Информация о WebSocket соединении"""
+    binary: bool
+    compressed: bool
+    batching: bool
+    connected_at: float
+    last_activity: float
+    session_id: str
+    messages_sent: int = 0
+    messages_received: int = 0
+    services_subscribed: Set[str] = field(default_factory=set)
+    writer: Optional[asyncio.Task] = None
+    # Очередь исходящих сообщений и номер формата (CODEC_*)
+    queue: Optional[asyncio.Queue] = None
+    codec: int = CODEC_JSON
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Представление соединения для JSON"""
+        return {
+            "binary": self.binary,
+            "compressed": self.compressed,
+            "batching": self.batching,
+            "connected_at": self.connected_at,
+            "last_activity": self.last_activity,
+            "messages_sent": self.messages_sent,
+            "messages_received": self.messages_received,
+            "session_id": self.session_id,
+            "services_subscribed": list(self.services_subscribed)
+        }
+
 class WebSocketManager:
     """Менеджер WebSocket соединений для API Gateway"""
     
     def __init__(self):
         self.active_connections: Set[WebSocket] = set()
-        self.connection_info: Dict[WebSocket, Dict[str, Any]] = {}
+        self.connection_info: Dict[WebSocket, ConnInfo] = {}
+        # Время последней активности; в начале - самые давно неактивные соединения
+        self._activity: "OrderedDict[WebSocket, float]" = OrderedDict()
         self.service_connections: Dict[str, Set[WebSocket]] = defaultdict(set)
-        self.message_queues: Dict[WebSocket, asyncio.Queue] = {}
+        
+        # Неизменяемые снимки получателей (соединение, ConnInfo) для рассылок;
+        # пересобираются только при подключении/отключении и подписке/отписке
+        self._active_tuple: Tuple[Tuple[WebSocket, ConnInfo], ...] = ()
+        self._service_tuples: Dict[str, Tuple[Tuple[WebSocket, ConnInfo], ...]] = {}
+        # Входящие сообщения: очередь и событие "есть новые сообщения"
+        self.message_queues: Dict[WebSocket, Tuple[Deque[Dict[str, Any]], asyncio.Event]] = {}
+        
+        # Блокировка изменения наборов соединений; отправка выполняется вне ее
+        self._lock = asyncio.Lock()
+        
+        # Обработчики служебных сообщений по типу
+        self._handlers = {
+            "subscribe_service": self._handle_subscribe,
+            "unsubscribe_service": self._handle_unsubscribe,
+            "ping": self._handle_ping,
+            "get_stats": self._handle_get_stats,
+            "get_connection_info": self._handle_get_connection_info,
+            "get_subscribed_services": self._handle_get_subscribed_services
+        }
+        
+        self._check_event_loop()
         
         # Статистика
         self.stats = {
             "total_connections": 0,
             "active_connections": 0,
-            "messages_routed": 0,
             "messages_failed": 0,
+            "messages_dropped": 0,
             "errors": 0
         }
+        
+        # Сообщения закрытых соединений; для открытых счетчики хранятся в ConnInfo
+        # и суммируются в get_stats
+        self._routed_closed = 0
+    
+    def _check_event_loop(self):
+        """Предупреждение, если менеджер работает не в цикле событий uvloop"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        
+        if not type(loop).__module__.startswith("uvloop"):
+            logger.warning(
+                f"Gateway WebSocket manager runs on {type(loop).__name__}, not uvloop; "
+                f"start uvicorn with --loop uvloop for better WebSocket throughput"
+            )
     
     async def connect(self, websocket: WebSocket):
         """Подключение нового WebSocket клиента"""
         try:
-            await websocket.accept()
+            # Клиент может запросить MessagePack или сжатый JSON через подпротокол
+            offered = websocket.scope.get("subprotocols", ())
+            if MSGPACK_SUBPROTOCOL in offered:
+                subprotocol = MSGPACK_SUBPROTOCOL
+            elif ZLIB_SUBPROTOCOL in offered:
+                subprotocol = ZLIB_SUBPROTOCOL
+            else:
+                subprotocol = None
+            binary = subprotocol is not None
+            compressed = subprotocol == ZLIB_SUBPROTOCOL
+            # Сжатые кадры не склеиваются
+            batching = not compressed and websocket.query_params.get(BATCH_QUERY_PARAM) in ("1", "true")
+            await websocket.accept(subprotocol=subprotocol)
             
             # Добавление в активные соединения
+            now = time.monotonic()
             self.active_connections.add(websocket)
-            self.connection_info[websocket] = {
-                "connected_at": asyncio.get_event_loop().time(),
-                "last_activity": asyncio.get_event_loop().time(),
-                "messages_sent": 0,
-                "messages_received": 0,
-                "session_id": f"gateway_session_{len(self.active_connections)}",
-                "services_subscribed": set()
-            }
+            info = self.connection_info[websocket] = ConnInfo(
+                binary=binary,
+                compressed=compressed,
+                batching=batching,
+                connected_at=now,
+                last_activity=now,
+                session_id=f"gateway_session_{len(self.active_connections)}",
+                queue=asyncio.Queue(maxsize=QUEUE_MAX_SIZE),
+                codec=CODEC_ZLIB if compressed else CODEC_MSGPACK if binary else CODEC_JSON
+            )
+            self._active_tuple = tuple(self.connection_info.items())
+            setattr(websocket, CONN_STATE_ATTR, info)
+            self._activity[websocket] = now
             
             # Создание очереди сообщений
-            self.message_queues[websocket] = asyncio.Queue()
+            self.message_queues[websocket] = (deque(maxlen=QUEUE_MAX_SIZE), asyncio.Event())
+            
+            # Задача, отправляющая исходящие сообщения (пачками, если клиент согласился)
+            info.writer = asyncio.create_task(
+                self._writer_loop(websocket, info.queue, binary,
+                                  MAX_SEND_BATCH if batching else 1)
+            )
             
             # Обновление статистики
             self.stats["total_connections"] += 1
@@ -60,8 +206,8 @@ class WebSocketManager:
             await self.send_message(websocket, {
                 "type": "connection_established",
                 "message": "Подключение к API Gateway установлено",
-                "session_id": self.connection_info[websocket]["session_id"],
-                "server_time": asyncio.get_event_loop().time()
+                "session_id": info.session_id,
+                "server_time": now
             })
             
         except Exception as e:
@@ -72,25 +218,12 @@ class WebSocketManager:
     async def disconnect(self, websocket: WebSocket):
         """Отключение WebSocket клиента"""
         try:
-            # Удаление из активных соединений
-            if websocket in self.active_connections:
-                self.active_connections.remove(websocket)
-            
-            # Удаление из подписок на сервисы
-            if websocket in self.connection_info:
-                for service in self.connection_info[websocket]["services_subscribed"]:
-                    self.service_connections[service].discard(websocket)
-                    if not self.service_connections[service]:
-                        del self.service_connections[service]
+            async with self._lock:
+                if self._remove_connection(websocket):
+                    self._active_tuple = tuple(self.connection_info.items())
                 
-                del self.connection_info[websocket]
-            
-            # Удаление очереди сообщений
-            if websocket in self.message_queues:
-                del self.message_queues[websocket]
-            
-            # Обновление статистики
-            self.stats["active_connections"] = len(self.active_connections)
+                # Обновление статистики
+                self.stats["active_connections"] = len(self.active_connections)
             
             logger.info(f"Gateway WebSocket client disconnected. Active connections: {self.stats['active_connections']}")
             
@@ -98,51 +231,239 @@ class WebSocketManager:
             logger.error(f"Error during Gateway WebSocket disconnect: {e}")
             self.stats["errors"] += 1
     
+    def _remove_connection(self, websocket: WebSocket) -> bool:
+        """Удаление соединения из всех наборов (вызывается под self._lock)
+        
+        Снимок _active_tuple не пересобирается - это делает вызывающий один раз
+        на все удаленные соединения. Возвращает True, если соединение было известно.
+        """
+        # Удаление из активных соединений
+        self.active_connections.discard(websocket)
+        self._activity.pop(websocket, None)
+        
+        # Удаление очереди сообщений
+        self.message_queues.pop(websocket, None)
+        
+        info = self.connection_info.pop(websocket, None)
+        if info is None:
+            return False
+        
+        self._routed_closed += info.messages_sent + info.messages_received
+        setattr(websocket, CONN_STATE_ATTR, None)
+        
+        # Удаление из подписок на сервисы
+        for service in info.services_subscribed:
+            self.service_connections[service].discard(websocket)
+            if not self.service_connections[service]:
+                del self.service_connections[service]
+            self._refresh_service_tuple(service)
+        
+        # Остановка отправителя (кроме случая, когда он сам закрывает соединение)
+        writer = info.writer
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+        
+        return True
+    
     async def send_message(self, websocket: WebSocket, message: Dict[str, Any]):
-        """Отправка сообщения конкретному клиенту"""
+        """Отправка сообщения конкретному клиенту
+        
+        Сообщение ставится в очередь отправителя соединения, поэтому порядок
+        относительно рассылок сохраняется.
+        """
+        info = getattr(websocket, CONN_STATE_ATTR, None)
+        if info is not None:
+            try:
+                payload = self._encode(message, info.binary, info.compressed)
+            except _ENCODE_ERRORS as e:
+                logger.error(f"Failed to encode Gateway message: {e}")
+                self.stats["messages_failed"] += 1
+                self.stats["errors"] += 1
+                return
+            
+            if self._enqueue_prepared(websocket, payload) and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Gateway message queued: {message.get('type', 'unknown')}")
+    
+    async def _send_prepared(self, websocket: WebSocket, payload: Union[str, bytes], binary: bool,
+                             count: int = 1) -> bool:
+        """Отправка уже сериализованного сообщения (или пачки из count сообщений) клиенту"""
         try:
-            if websocket in self.active_connections:
-                message_json = json.dumps(message, ensure_ascii=False)
-                await websocket.send_text(message_json)
-                
-                # Обновление статистики
-                self.stats["messages_routed"] += 1
-                
-                # Обновление информации о соединении
-                if websocket in self.connection_info:
-                    self.connection_info[websocket]["last_activity"] = asyncio.get_event_loop().time()
-                    self.connection_info[websocket]["messages_sent"] += 1
-                
-                logger.debug(f"Gateway message sent: {message.get('type', 'unknown')}")
-                
-        except Exception as e:
+            if binary:
+                await websocket.send_bytes(payload)
+            else:
+                await websocket.send_text(payload)
+            
+            # Обновление информации о соединении
+            info = getattr(websocket, CONN_STATE_ATTR, None)
+            if info is not None:
+                self._touch(websocket, info)
+                info.messages_sent += count
+            
+            return True
+            
+        except _SEND_ERRORS as e:
             logger.error(f"Failed to send Gateway message: {e}")
             self.stats["messages_failed"] += 1
             self.stats["errors"] += 1
             
             # Удаление неактивного соединения
             await self.disconnect(websocket)
+            return False
+    
+    def _touch(self, websocket: WebSocket, info: ConnInfo):
+        """Отметка активности соединения (перенос в конец порядка активности)"""
+        now = time.monotonic()
+        info.last_activity = now
+        self._activity[websocket] = now
+        self._activity.move_to_end(websocket)
+    
+    def _encode(self, message: Dict[str, Any], binary: bool, compressed: bool = False) -> Union[str, bytes]:
+        """Сериализация сообщения в формат соединения"""
+        if compressed:
+            return self._compress(orjson.dumps(message))
+        if binary:
+            return msgpack.packb(message, use_bin_type=True)
+        # Текстовый кадр: orjson выдает UTF-8 байты, декодируются один раз на сообщение
+        return orjson.dumps(message).decode("utf-8")
+    
+    def _compress(self, raw: bytes) -> bytes:
+        """Сжатие JSON кадра; сжатие без заметного выигрыша не используется"""
+        compressed = zlib.compress(raw, 1)
+        if len(compressed) < len(raw) * 0.9:
+            return ZLIB_COMPRESSED_FLAG + compressed
+        return ZLIB_RAW_FLAG + raw
+    
+    def _encode_batch(self, payloads: List[Union[str, bytes]], binary: bool) -> Union[str, bytes]:
+        """Склейка уже сериализованных сообщений в один кадр {"type": "batch", "items": [...]}"""
+        if binary:
+            return _MSGPACK_BATCH_PREFIX + _msgpack_packer.pack_array_header(len(payloads)) + b"".join(payloads)
+        return '{"type":"batch","items":[' + ",".join(payloads) + "]}"
+    
+    def enqueue(self, websocket: WebSocket, message: Dict[str, Any]) -> bool:
+        """Постановка сообщения в очередь отправки клиента"""
+        info = getattr(websocket, CONN_STATE_ATTR, None)
+        if info is None:
+            return False
+        return self._enqueue_prepared(websocket, self._encode(message, info.binary, info.compressed))
+    
+    def _enqueue_prepared(self, websocket: WebSocket, payload: Union[str, bytes]) -> bool:
+        """Постановка уже сериализованного сообщения в очередь отправки без ожидания"""
+        info = getattr(websocket, CONN_STATE_ATTR, None)
+        if info is None:
+            return False
+        self._put_drop_oldest(info.queue, payload)
+        return True
+    
+    def _put_drop_oldest(self, queue: asyncio.Queue, item: Any):
+        """Добавление в ограниченную очередь с вытеснением самого старого элемента
+        
+        Медленный клиент не должен копить сообщения бесконечно.
+        """
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+            queue.put_nowait(item)
+            self.stats["messages_dropped"] += 1
+            return
+        
+        if queue.qsize() == QUEUE_WARNING_SIZE:
+            logger.warning(f"Gateway send queue is 80% full ({QUEUE_WARNING_SIZE}/{QUEUE_MAX_SIZE})")
+    
+    def _push_inbound(self, entry: Tuple[Deque[Dict[str, Any]], asyncio.Event], message: Dict[str, Any]):
+        """Добавление входящего сообщения без ожидания
+        
+        deque с maxlen сам вытесняет самое старое сообщение при переполнении.
+        """
+        items, ready = entry
+        if len(items) == QUEUE_MAX_SIZE:
+            self.stats["messages_dropped"] += 1
+        items.append(message)
+        ready.set()
+        
+        if len(items) == QUEUE_WARNING_SIZE:
+            logger.warning(f"Gateway inbound queue is 80% full ({QUEUE_WARNING_SIZE}/{QUEUE_MAX_SIZE})")
+    
+    async def _writer_loop(self, websocket: WebSocket, queue: asyncio.Queue, binary: bool,
+                           batch_limit: int = MAX_SEND_BATCH):
+        """Отправка исходящих сообщений соединения
+        
+        Ждет первое сообщение, затем без ожидания забирает накопившиеся
+        (не более batch_limit) и отправляет их одним кадром. Клиентам без
+        ?batch=1 и сжатым соединениям каждое сообщение уходит своим кадром
+        (batch_limit = 1).
+        
+        Пачка уходит одной записью в транспорт, т.е. одним системным вызовом
+        на клиента вместо одного на сообщение. Запись в сокет в обход ASGI
+        (например через io_uring) невозможна: кадрированием и состоянием
+        соединения управляет протокол uvicorn.
+        """
+        while True:
+            batch = [await queue.get()]
+            try:
+                while len(batch) < batch_limit:
+                    batch.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                pass
+            
+            if len(batch) == 1:
+                frame = batch[0]
+            else:
+                frame = self._encode_batch(batch, binary)
+            
+            if not await self._send_prepared(websocket, frame, binary, len(batch)):
+                break
+    
+    async def receive_message(self, websocket: WebSocket) -> Tuple[Dict[str, Any], Optional[str]]:
+        """Получение сообщения клиента в формате соединения
+        
+        Возвращает разобранное сообщение и исходный JSON текст (None для MessagePack).
+        Клиенты со сжатием отправляют обычный текстовый JSON.
+        """
+        info = getattr(websocket, CONN_STATE_ATTR, None)
+        if info is not None and info.binary and not info.compressed:
+            data = await websocket.receive_bytes()
+            return msgpack.unpackb(data, raw=False), None
+        
+        data = await websocket.receive_text()
+        return orjson.loads(data), data
     
     async def broadcast_message(self, message: Dict[str, Any], service: str = None):
         """Отправка сообщения всем клиентам или клиентам подписанным на сервис"""
         try:
-            if service and service in self.service_connections:
-                # Отправка клиентам подписанным на конкретный сервис
-                connections = self.service_connections[service].copy()
-            else:
-                # Отправка всем активным соединениям
-                connections = self.active_connections.copy()
+            # Снимки неизменяемы, поэтому берутся без копирования и без блокировки
+            connections = self._service_tuples.get(service) if service else None
+            if not connections:
+                # Отправка всем активным соединениям (в том числе, если у сервиса
+                # нет подписчиков)
+                connections = self._active_tuple
             
-            # Отправка сообщения всем соединениям
-            tasks = []
-            for websocket in connections:
-                if websocket in self.active_connections:
-                    tasks.append(self.send_message(websocket, message))
+            # Сериализация один раз на формат (индекс - CODEC_*), а не для каждого клиента
+            payloads = [None, None, None]
+            dead = []
             
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
+            # Постановка сообщения в очереди отправки всех соединений (вне блокировки)
+            for websocket, info in connections:
+                if info.writer.done():
+                    # Отправитель завершился - соединение мертво
+                    dead.append(websocket)
+                    continue
+                
+                # Сжатый кадр тоже строится один раз и разделяется всеми получателями
+                payload = payloads[info.codec]
+                if payload is None:
+                    payload = payloads[info.codec] = self._encode(message, info.binary, info.compressed)
+                self._put_drop_oldest(info.queue, payload)
             
-            logger.info(f"Gateway message broadcasted to {len(connections)} clients")
+            # Удаление мертвых соединений (disconnect берет блокировку сам)
+            for websocket in dead:
+                await self.disconnect(websocket)
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Gateway message broadcasted to {len(connections) - len(dead)} clients")
             
         except Exception as e:
             logger.error(f"Failed to broadcast Gateway message: {e}")
@@ -151,11 +472,11 @@ class WebSocketManager:
     async def subscribe_to_service(self, websocket: WebSocket, service: str):
         """Подписка клиента на сообщения от сервиса"""
         try:
-            if websocket in self.active_connections:
+            info = getattr(websocket, CONN_STATE_ATTR, None)
+            if info is not None:
                 self.service_connections[service].add(websocket)
-                
-                if websocket in self.connection_info:
-                    self.connection_info[websocket]["services_subscribed"].add(service)
+                self._refresh_service_tuple(service)
+                info.services_subscribed.add(service)
                 
                 # Отправка уведомления о подписке
                 await self.send_message(websocket, {
@@ -170,14 +491,23 @@ class WebSocketManager:
             logger.error(f"Failed to subscribe to service: {e}")
             self.stats["errors"] += 1
     
+    def _refresh_service_tuple(self, service: str):
+        """Пересборка снимка подписчиков сервиса"""
+        subscribers = self.service_connections.get(service)
+        if subscribers:
+            self._service_tuples[service] = tuple((ws, self.connection_info[ws]) for ws in subscribers)
+        else:
+            self._service_tuples.pop(service, None)
+    
     async def unsubscribe_from_service(self, websocket: WebSocket, service: str):
         """Отписка клиента от сообщений сервиса"""
         try:
             if service in self.service_connections and websocket in self.service_connections[service]:
                 self.service_connections[service].discard(websocket)
                 
-                if websocket in self.connection_info:
-                    self.connection_info[websocket]["services_subscribed"].discard(service)
+                info = getattr(websocket, CONN_STATE_ATTR, None)
+                if info is not None:
+                    info.services_subscribed.discard(service)
                 
                 # Отправка уведомления об отписке
                 await self.send_message(websocket, {
@@ -189,6 +519,7 @@ class WebSocketManager:
                 # Удаление пустой подписки
                 if not self.service_connections[service]:
                     del self.service_connections[service]
+                self._refresh_service_tuple(service)
                 
                 logger.info(f"Gateway WebSocket client unsubscribed from service: {service}")
                 
@@ -199,72 +530,92 @@ class WebSocketManager:
     async def handle_message(self, websocket: WebSocket, message: Dict[str, Any]):
         """Обработка входящего сообщения"""
         try:
-            # Обновление статистики
-            self.stats["messages_routed"] += 1
-            
             # Обновление информации о соединении
-            if websocket in self.connection_info:
-                self.connection_info[websocket]["last_activity"] = asyncio.get_event_loop().time()
-                self.connection_info[websocket]["messages_received"] += 1
+            info = getattr(websocket, CONN_STATE_ATTR, None)
+            if info is not None:
+                self._touch(websocket, info)
+                info.messages_received += 1
             
             message_type = message.get("type")
             
-            # Обработка различных типов сообщений
-            if message_type == "subscribe_service":
-                service = message.get("service")
-                if service:
-                    await self.subscribe_to_service(websocket, service)
-            
-            elif message_type == "unsubscribe_service":
-                service = message.get("service")
-                if service:
-                    await self.unsubscribe_from_service(websocket, service)
-            
-            elif message_type == "ping":
-                await self.send_message(websocket, {
-                    "type": "pong",
-                    "timestamp": asyncio.get_event_loop().time()
-                })
-            
-            elif message_type == "get_stats":
-                await self.send_message(websocket, {
-                    "type": "stats_response",
-                    "stats": self.get_stats()
-                })
-            
-            elif message_type == "get_connection_info":
-                connection_info = self.get_connection_info(websocket)
-                await self.send_message(websocket, {
-                    "type": "connection_info",
-                    "info": connection_info
-                })
-            
-            elif message_type == "get_subscribed_services":
-                if websocket in self.connection_info:
-                    services = list(self.connection_info[websocket]["services_subscribed"])
-                    await self.send_message(websocket, {
-                        "type": "subscribed_services",
-                        "services": services
-                    })
-            
-            else:
+            # Обработка служебных типов сообщений через таблицу обработчиков
+            handler = self._handlers.get(message_type)
+            if handler is not None:
+                await handler(websocket, message)
+            elif websocket in self.message_queues:
                 # Передача сообщения в очередь для обработки
-                if websocket in self.message_queues:
-                    await self.message_queues[websocket].put(message)
+                self._push_inbound(self.message_queues[websocket], message)
             
-            logger.debug(f"Gateway message handled: {message_type}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Gateway message handled: {message_type}")
             
         except Exception as e:
             logger.error(f"Failed to handle Gateway message: {e}")
             self.stats["errors"] += 1
     
+    async def _handle_subscribe(self, websocket: WebSocket, message: Dict[str, Any]):
+        """Обработка subscribe_service"""
+        service = message.get("service")
+        if service:
+            await self.subscribe_to_service(websocket, service)
+    
+    async def _handle_unsubscribe(self, websocket: WebSocket, message: Dict[str, Any]):
+        """Обработка unsubscribe_service"""
+        service = message.get("service")
+        if service:
+            await self.unsubscribe_from_service(websocket, service)
+    
+    async def _handle_ping(self, websocket: WebSocket, message: Dict[str, Any]):
+        """Обработка ping: кадр pong собирается из заготовки без сериализации"""
+        info = getattr(websocket, CONN_STATE_ATTR, None)
+        if info is None:
+            return
+        
+        timestamp = time.monotonic()
+        if info.codec == CODEC_MSGPACK:
+            payload = _PONG_MSGPACK_PREFIX + msgpack.packb(timestamp)
+        else:
+            payload = _PONG_JSON_PREFIX + repr(timestamp) + "}"
+            if info.codec == CODEC_ZLIB:
+                # Кадр слишком мал для сжатия
+                payload = ZLIB_RAW_FLAG + payload.encode("utf-8")
+        self._enqueue_prepared(websocket, payload)
+    
+    async def _handle_get_stats(self, websocket: WebSocket, message: Dict[str, Any]):
+        """Обработка get_stats"""
+        await self.send_message(websocket, {
+            "type": "stats_response",
+            "stats": self.get_stats()
+        })
+    
+    async def _handle_get_connection_info(self, websocket: WebSocket, message: Dict[str, Any]):
+        """Обработка get_connection_info"""
+        await self.send_message(websocket, {
+            "type": "connection_info",
+            "info": self.get_connection_info(websocket)
+        })
+    
+    async def _handle_get_subscribed_services(self, websocket: WebSocket, message: Dict[str, Any]):
+        """Обработка get_subscribed_services"""
+        info = getattr(websocket, CONN_STATE_ATTR, None)
+        if info is not None:
+            await self.send_message(websocket, {
+                "type": "subscribed_services",
+                "services": list(info.services_subscribed)
+            })
+    
     async def get_message(self, websocket: WebSocket) -> Dict[str, Any]:
         """Получение сообщения из очереди"""
         try:
-            if websocket in self.message_queues:
-                return await self.message_queues[websocket].get()
-            else:
+            entry = self.message_queues.get(websocket)
+            if entry is None:
                 return None
+            
+            items, ready = entry
+            while not items:
+                ready.clear()
+                await ready.wait()
+            return items.popleft()
                 
         except Exception as e:
             logger.error(f"Failed to get Gateway message: {e}")
@@ -272,7 +623,8 @@ class WebSocketManager:
     
     def get_connection_info(self, websocket: WebSocket) -> Dict[str, Any]:
         """Получение информации о соединении"""
-        return self.connection_info.get(websocket, {})
+        info = getattr(websocket, CONN_STATE_ATTR, None)
+        return info.to_dict() if info is not None else {}
     
     def get_service_subscribers(self, service: str) -> List[WebSocket]:
         """Получение списка подписчиков на сервис"""
@@ -280,32 +632,46 @@ class WebSocketManager:
     
     def get_stats(self) -> Dict[str, Any]:
         """Получение статистики"""
+        routed = self._routed_closed + sum(
+            info.messages_sent + info.messages_received for info in self.connection_info.values()
+        )
         return {
             **self.stats,
+            "messages_routed": routed,
             "service_subscriptions": {
                 service: len(connections) 
                 for service, connections in self.service_connections.items()
             },
             "avg_messages_per_connection": (
-                self.stats["messages_routed"] / max(self.stats["total_connections"], 1)
+                routed / max(self.stats["total_connections"], 1)
             )
         }
     
     async def cleanup_inactive_connections(self, timeout: int = 300):
         """Очистка неактивных соединений"""
         try:
-            current_time = asyncio.get_event_loop().time()
+            cutoff = time.monotonic() - timeout
             inactive_connections = []
             
-            for websocket, info in self.connection_info.items():
-                if current_time - info["last_activity"] > timeout:
-                    inactive_connections.append(websocket)
-            
-            for websocket in inactive_connections:
-                logger.info("Removing inactive Gateway WebSocket connection")
-                await self.disconnect(websocket)
+            # Соединения упорядочены по активности - просматриваются только истекшие
+            for websocket, last_activity in self._activity.items():
+                if last_activity >= cutoff:
+                    break
+                inactive_connections.append(websocket)
             
             if inactive_connections:
+                # Учет удаления - одним захватом блокировки для всех соединений
+                async with self._lock:
+                    for websocket in inactive_connections:
+                        self._remove_connection(websocket)
+                    self._active_tuple = tuple(self.connection_info.items())
+                    self.stats["active_connections"] = len(self.active_connections)
+                
+                # Закрытие сокетов одновременно и вне блокировки
+                await asyncio.gather(
+                    *(websocket.close(code=1000) for websocket in inactive_connections),
+                    return_exceptions=True
+                )
                 logger.info(f"Cleaned up {len(inactive_connections)} inactive Gateway connections")
                 
         except Exception as e:
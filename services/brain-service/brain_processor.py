@@ -3,9 +3,13 @@ AI процессор для Brain Service
 Интеграция Phi-2 и других моделей для обработки команд
 """
 import asyncio
+import hashlib
 import time
 import torch
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from typing import Dict, List, Optional, Any, Tuple
 from transformers import (
     AutoTokenizer, 
@@ -23,6 +27,36 @@ from utils.logger import get_logger
 
 logger = get_logger("brain-processor")
 
+# Размер батча при вычислении эмбеддингов
+EMBEDDING_BATCH_SIZE = 64
+
+# Максимальное число эмбеддингов в LRU кэше
+EMBEDDING_CACHE_SIZE = 10_000
+
+# Микробатчинг генерации: максимум запросов в батче и время ожидания попутчиков (сек)
+GENERATION_BATCH_SIZE = 8
+GENERATION_BATCH_WAIT = 0.005
+
+# Блоки кода в markdown формате
+_CODE_BLOCK_RE = re.compile(r'```(?:python|py|javascript|js|html|css|json|sql)?\n(.*?)\n```', re.DOTALL)
+
+def _torch_compile_available() -> bool:
+    """torch.compile поддерживается (PyTorch 2.1+)"""
+    try:
+        major, minor = (int(part) for part in torch.__version__.split(".")[:2])
+    except ValueError:
+        return False
+    return hasattr(torch, "compile") and (major, minor) >= (2, 1)
+
+@dataclass
+class _GenerationRequest:
+    """Запрос генерации в очереди микробатчинга"""
+    input_ids: List[int]
+    max_tokens: int
+    temperature: float
+    prefix_type: Optional[str]  # тип системного промпта, с которого начинаются input_ids
+    future: asyncio.Future
+
 class BrainProcessor:
     """AI процессор с поддержкой Phi-2 и других моделей"""
     
@@ -36,8 +70,27 @@ class BrainProcessor:
         self.embedding_model = None
         self.classification_pipeline = None
         
-        # Кэш для эмбеддингов
-        self._embedding_cache = {}
+        # Модель Phi-2 работает через torch.compile / загружена в int4
+        self.phi2_compiled = False
+        self.phi2_quantized = False
+        
+        # LRU кэш эмбеддингов по дайджесту текста (векторы хранятся в fp16)
+        self._embedding_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        
+        # Токены системных промптов и их KV-кэш по типу промпта
+        self._system_prefix_cache: Dict[str, Tuple[torch.Tensor, Any]] = {}
+        self._prefix_cache_enabled = True
+        
+        # Токены системных промптов (промпт токенизируется только после них)
+        self._system_token_cache: Dict[str, List[int]] = {}
+        
+        # Пул для токенизации и сборки промптов вне event loop
+        self._tok_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="phi2-tokenize")
+        
+        # Очередь микробатчинга генерации и поток, в котором выполняется generate()
+        self._gen_queue: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        self._gen_pool: Optional[ThreadPoolExecutor] = None
         
         # Системные промпты
         self.system_prompts = {
@@ -74,10 +127,27 @@ class BrainProcessor:
             import os
             os.makedirs(self.config.model_path, exist_ok=True)
             
-            # Загрузка моделей
-            await self._load_phi2_model()
-            await self._load_embedding_model()
-            await self._load_classification_pipeline()
+            # Параллельная загрузка моделей (зависимостей между ними нет)
+            phi2_result, embedding_result, _ = await asyncio.gather(
+                self._load_phi2_model(),
+                self._load_embedding_model(),
+                self._load_classification_pipeline(),
+                return_exceptions=True
+            )
+            
+            # Phi-2 и эмбеддинги обязательны; классификация опциональна
+            for result in (phi2_result, embedding_result):
+                if isinstance(result, BaseException):
+                    raise result
+            
+            # Запуск микробатчинга. generate() выполняется последовательно
+            # в одном потоке, чтобы вызовы модели не конкурировали за GPU
+            self._gen_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="phi2-generate")
+            self._gen_queue = asyncio.Queue()
+            self._batch_task = asyncio.create_task(self._batch_loop())
+            
+            # Компиляция и прогрев Phi-2
+            await self._compile_phi2_model()
             
             logger.info("Brain processor models loaded successfully")
             
@@ -90,13 +160,30 @@ class BrainProcessor:
         try:
             logger.info(f"Loading Phi-2 model: {self.config.phi2_model}")
             
-            # Конфигурация для CPU
+            # Половинная точность на GPU (bf16 на Ampere+, иначе fp16);
+            # на CPU остается fp32 - большинство x86 CPU не умеют bf16 matmul
+            if self.device == "cuda":
+                dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            else:
+                dtype = torch.float32
+            
             model_kwargs = {
-                "torch_dtype": torch.float32,
+                "torch_dtype": dtype,
                 "device_map": "auto" if self.device == "cuda" else None,
                 "trust_remote_code": True
             }
             
+            # Опциональная 4-битная квантизация NF4 (только CUDA, device_map="auto").
+            # Вес модели меньше в ~4 раза, но при малом батче декодирование может быть медленнее
+            quantization_config = self._get_quantization_config(dtype)
+            if quantization_config is not None:
+                model_kwargs["quantization_config"] = quantization_config
+                self.phi2_quantized = True
+            
+            # KV-кэш и токены префиксов относятся к предыдущей модели
+            self._system_prefix_cache.clear()
+            self._system_token_cache.clear()
+            
             # Загрузка в отдельном потоке
             loop = asyncio.get_event_loop()
             
@@ -121,13 +208,75 @@ class BrainProcessor:
             # Настройка токенизатора
             if self.phi2_tokenizer.pad_token is None:
                 self.phi2_tokenizer.pad_token = self.phi2_tokenizer.eos_token
+            # Дополнение слева, чтобы генерация продолжала сам промпт
+            self.phi2_tokenizer.padding_side = "left"
             
-            logger.info("Phi-2 model loaded successfully")
+            logger.info(f"Phi-2 model loaded successfully ({'int4' if self.phi2_quantized else dtype})")
             
         except Exception as e:
             logger.error(f"Failed to load Phi-2 model: {e}")
             raise
     
+    def _get_quantization_config(self, compute_dtype: torch.dtype) -> Optional[BitsAndBytesConfig]:
+        """Конфигурация int4 квантизации, если она включена и доступна
+        
+        compute_dtype - тип вычислений модели (bf16 только на GPU с его поддержкой)
+        """
+        if self.config.quantization != "int4":
+            return None
+        
+        if self.device != "cuda":
+            logger.warning("int4 quantization requires CUDA, loading Phi-2 without it")
+            return None
+        
+        try:
+            import bitsandbytes  # noqa: F401
+        except ImportError:
+            logger.warning("bitsandbytes is not installed, loading Phi-2 without int4 quantization")
+            return None
+        
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=compute_dtype,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True
+        )
+    
+    async def _compile_phi2_model(self):
+        """Компиляция forward Phi-2 через torch.compile с прогревом
+        
+        Компилируется forward, а не сам модуль: generate() вызывает forward
+        исходной модели. KV-кэш generate() растет на токен за шаг, поэтому граф
+        компилируется с динамическими формами и без CUDA graphs (reduce-overhead
+        записывал бы граф на каждую длину кэша). Компиляция включается только
+        на CUDA и не для int4 ядер bitsandbytes. При любой ошибке модель
+        остается в eager режиме.
+        """
+        if self.device != "cuda" or self.phi2_quantized or not _torch_compile_available():
+            return
+        
+        eager_forward = self.phi2_model.forward
+        try:
+            logger.info("Compiling Phi-2 model with torch.compile")
+            
+            self.phi2_model.forward = torch.compile(
+                eager_forward,
+                mode="default",
+                dynamic=True,
+                fullgraph=False
+            )
+            self.phi2_compiled = True
+            
+            # Прогрев: компилируются оба графа - prefill и шаг декодирования
+            start_time = time.time()
+            await self._generate_text("Привет", max_tokens=2)
+            logger.info(f"Phi-2 model compiled in {time.time() - start_time:.1f}s")
+            
+        except Exception as e:
+            logger.error(f"torch.compile failed, falling back to eager Phi-2: {e}")
+            self.phi2_model.forward = eager_forward
+            self.phi2_compiled = False
+    
     async def _load_embedding_model(self):
         """Загрузка модели эмбеддингов"""
         try:
@@ -139,6 +288,10 @@ class BrainProcessor:
                 lambda: SentenceTransformer(self.config.embedding_model)
             )
             
+            # На GPU эмбеддинги считаются в fp16
+            if self.device == "cuda":
+                self.embedding_model = self.embedding_model.half().to(self.device)
+            
             logger.info("Embedding model loaded successfully")
             
         except Exception as e:
@@ -207,10 +360,10 @@ class BrainProcessor:
         """Обработка общей команды"""
         try:
             # Создание промпта
-            prompt = self._create_prompt(command, context, "assistant")
+            prompt = await self._build_prompt(command, context, "assistant")
             
             # Генерация ответа
-            response = await self._generate_text(prompt)
+            response = await self._generate_text(prompt, prompt_type="assistant")
             
             return {
                 "response": response,
@@ -225,10 +378,10 @@ class BrainProcessor:
         """Обработка команды, связанной с кодом"""
         try:
             # Создание промпта для анализа кода
-            prompt = self._create_prompt(command, context, "code_assistant")
+            prompt = await self._build_prompt(command, context, "code_assistant")
             
             # Генерация ответа
-            response = await self._generate_text(prompt)
+            response = await self._generate_text(prompt, prompt_type="code_assistant")
             
             # Извлечение кода из ответа
             code_blocks = self._extract_code_blocks(response)
@@ -248,8 +401,8 @@ class BrainProcessor:
         """Обработка команды выполнения задачи"""
         try:
             # Создание плана выполнения
-            plan_prompt = self._create_prompt(command, context, "task_planner")
-            plan_response = await self._generate_text(plan_prompt)
+            plan_prompt = await self._build_prompt(command, context, "task_planner")
+            plan_response = await self._generate_text(plan_prompt, prompt_type="task_planner")
             
             # Парсинг плана
             task_plan = self._parse_task_plan(plan_response)
@@ -268,10 +421,10 @@ class BrainProcessor:
         """Обработка вопроса"""
         try:
             # Создание промпта для ответа на вопрос
-            prompt = self._create_prompt(command, context, "assistant")
+            prompt = await self._build_prompt(command, context, "assistant")
             
             # Генерация ответа
-            response = await self._generate_text(prompt)
+            response = await self._generate_text(prompt, prompt_type="assistant")
             
             return {
                 "response": response,
@@ -290,13 +443,14 @@ class BrainProcessor:
             
             # Параметры по умолчанию
             max_tokens = max_tokens or self.config.max_tokens
-            temperature = temperature or self.config.temperature
+            if temperature is None:
+                temperature = self.config.temperature
             
             # Создание полного промпта
-            full_prompt = self._create_prompt(prompt, context, "assistant")
+            full_prompt = await self._build_prompt(prompt, context, "assistant")
             
             # Генерация текста
-            response = await self._generate_text(full_prompt, max_tokens, temperature)
+            response = await self._generate_text(full_prompt, max_tokens, temperature, prompt_type="assistant")
             
             generation_time = time.time() - start_time
             
@@ -311,50 +465,214 @@ class BrainProcessor:
             raise
     
     async def _generate_text(self, prompt: str, max_tokens: int = None, 
-                           temperature: float = None) -> str:
-        """Генерация текста с помощью Phi-2"""
-        if not self.phi2_model or not self.phi2_tokenizer:
+                           temperature: float = None, prompt_type: str = None) -> str:
+        """Генерация текста с помощью Phi-2
+        
+        Запрос ставится в очередь микробатчинга (см. _batch_loop): одновременные
+        запросы генерируются одним батчем. При temperature <= 0 используется
+        жадное декодирование.
+        """
+        if not self.phi2_model or not self.phi2_tokenizer or self._gen_queue is None:
             raise RuntimeError("Phi-2 model not loaded")
         
         try:
             # Параметры по умолчанию
             max_tokens = max_tokens or self.config.max_tokens
-            temperature = temperature or self.config.temperature
-            
-            # Токенизация
-            inputs = self.phi2_tokenizer(
-                prompt,
-                return_tensors="pt",
-                truncation=True,
-                max_length=2048
+            if temperature is None:
+                temperature = self.config.temperature
+            
+            loop = asyncio.get_running_loop()
+            input_ids, prefix_type = await loop.run_in_executor(
+                self._tok_pool, self._tokenize_prompt, prompt, prompt_type
             )
             
-            if self.device == "cuda":
-                inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            
-            # Генерация
-            with torch.no_grad():
-                outputs = self.phi2_model.generate(
-                    **inputs,
-                    max_new_tokens=max_tokens,
-                    temperature=temperature,
-                    do_sample=True,
-                    pad_token_id=self.phi2_tokenizer.eos_token_id,
-                    eos_token_id=self.phi2_tokenizer.eos_token_id
-                )
+            # Процессор мог быть остановлен, пока шла токенизация
+            if self._gen_queue is None:
+                raise RuntimeError("Phi-2 model not loaded")
             
-            # Декодирование
-            generated_text = self.phi2_tokenizer.decode(
-                outputs[0][inputs['input_ids'].shape[1]:],
-                skip_special_tokens=True
+            future = loop.create_future()
+            await self._gen_queue.put(
+                _GenerationRequest(input_ids, max_tokens, temperature, prefix_type, future)
             )
-            
-            return generated_text.strip()
+            return await future
             
         except Exception as e:
             logger.error(f"Text generation failed: {e}")
             raise
     
+    async def _batch_loop(self):
+        """Фоновый цикл микробатчинга запросов генерации
+        
+        Если за первым запросом очередь пуста, он выполняется сразу, без
+        ожидания. Иначе за GENERATION_BATCH_WAIT собираются до
+        GENERATION_BATCH_SIZE запросов с той же temperature и генерируются
+        одним вызовом generate(); остальные ждут следующего батча.
+        """
+        loop = asyncio.get_running_loop()
+        deferred: List[_GenerationRequest] = []
+        batch: List[_GenerationRequest] = []
+        
+        try:
+            while True:
+                request = deferred.pop(0) if deferred else await self._gen_queue.get()
+                batch = [request]
+                
+                if deferred or not self._gen_queue.empty():
+                    # Есть конкурирующие запросы - ждем попутчиков и собираем батч
+                    await asyncio.sleep(GENERATION_BATCH_WAIT)
+                    pending, deferred = deferred, []
+                    while not self._gen_queue.empty():
+                        pending.append(self._gen_queue.get_nowait())
+                    
+                    for item in pending:
+                        if len(batch) < GENERATION_BATCH_SIZE and item.temperature == request.temperature:
+                            batch.append(item)
+                        else:
+                            deferred.append(item)
+                
+                # Запросы, отмененные вызывающей стороной, не генерируем
+                batch = [item for item in batch if not item.future.done()]
+                if not batch:
+                    continue
+                
+                try:
+                    texts = await loop.run_in_executor(self._gen_pool, self._generate_batch, batch)
+                    for item, text in zip(batch, texts):
+                        if not item.future.done():
+                            item.future.set_result(text)
+                except Exception as e:
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                
+        except asyncio.CancelledError:
+            # Остановка: ожидающие запросы отменяются
+            while not self._gen_queue.empty():
+                deferred.append(self._gen_queue.get_nowait())
+            for item in batch + deferred:
+                item.future.cancel()
+            raise
+    
+    def _tokenize_prompt(self, prompt: str, prompt_type: Optional[str]) -> Tuple[List[int], Optional[str]]:
+        """Токены промпта (в пуле токенизации) и тип его системного промпта
+        
+        Токены системного промпта берутся из кэша, токенизируется только
+        остаток. Обрезка выполняется срезом, а не truncation=True: настройка
+        усечения меняет состояние fast токенизатора и ломает параллельные вызовы.
+        """
+        system_prompt = self.system_prompts.get(prompt_type)
+        if system_prompt is None or not prompt.startswith(system_prompt):
+            return self.phi2_tokenizer(prompt)["input_ids"][:2048], None
+        
+        system_ids = self._system_token_cache.get(prompt_type)
+        if system_ids is None:
+            system_ids = self._system_token_cache[prompt_type] = self.phi2_tokenizer(system_prompt)["input_ids"]
+        
+        delta_ids = self.phi2_tokenizer(prompt[len(system_prompt):], add_special_tokens=False)["input_ids"]
+        return (system_ids + delta_ids)[:2048], prompt_type
+    
+    def _generate_batch(self, batch: List[_GenerationRequest]) -> List[str]:
+        """Генерация для батча запросов с одинаковой temperature (в потоке генерации)
+        
+        Одиночный запрос, начинающийся с системного промпта, берет его KV-кэш
+        готовым. Батч дополняется слева до самого длинного промпта, поэтому
+        сгенерированные токены всех строк начинаются с одной позиции.
+        """
+        temperature = batch[0].temperature
+        max_tokens = max(item.max_tokens for item in batch)
+        
+        generate_kwargs = {}
+        if temperature > 0:
+            generate_kwargs.update(do_sample=True, temperature=temperature)
+        else:
+            # temperature <= 0 - жадное декодирование без softmax и сэмплирования
+            generate_kwargs.update(do_sample=False, num_beams=1)
+        
+        prefix = None
+        if len(batch) == 1:
+            prefix = self._get_system_prefix(batch[0].prefix_type)
+        
+        if prefix is not None:
+            # Системная часть промпта уже посчитана - ее KV-кэш передается в generate()
+            prefix_ids, generate_kwargs["past_key_values"] = prefix
+            input_ids = torch.tensor([batch[0].input_ids], device=prefix_ids.device)
+            inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        else:
+            # Дополнение слева до самого длинного промпта батча
+            inputs = self.phi2_tokenizer.pad(
+                {"input_ids": [item.input_ids for item in batch]},
+                padding="longest",
+                return_tensors="pt"
+            )
+        
+        if self.device == "cuda" and prefix is None:
+            # Асинхронное копирование из закрепленной памяти; generate() идет
+            # в том же CUDA потоке, поэтому дожидаться копирования не нужно
+            inputs = {k: v.pin_memory().to(self.device, non_blocking=True) for k, v in inputs.items()}
+        
+        # Генерация (inference_mode дешевле no_grad: нет счетчиков версий тензоров)
+        with torch.inference_mode():
+            outputs = self.phi2_model.generate(
+                **inputs,
+                max_new_tokens=max_tokens,
+                pad_token_id=self.phi2_tokenizer.eos_token_id,
+                eos_token_id=self.phi2_tokenizer.eos_token_id,
+                **generate_kwargs
+            )
+        
+        # Декодирование (каждая строка обрезается до своего max_tokens)
+        prompt_length = inputs['input_ids'].shape[1]
+        return [
+            self.phi2_tokenizer.decode(
+                outputs[row][prompt_length:prompt_length + item.max_tokens],
+                skip_special_tokens=True
+            ).strip()
+            for row, item in enumerate(batch)
+        ]
+    
+    def _get_system_prefix(self, prompt_type: Optional[str]) -> Optional[Tuple[torch.Tensor, Any]]:
+        """Токены системного промпта и копия их past_key_values
+        
+        KV-кэш вычисляется один раз и хранится в формате кортежей. Каждый вызов
+        получает свою копию: generate() может дополнять кэш на месте.
+        """
+        if not self._prefix_cache_enabled or prompt_type is None:
+            return None
+        
+        cached = self._system_prefix_cache.get(prompt_type)
+        if cached is None:
+            try:
+                input_ids = torch.tensor([self._system_token_cache[prompt_type]])
+                if self.device == "cuda":
+                    input_ids = input_ids.to(self.device)
+                
+                # KV-кэш создается в том же режиме, в котором используется в generate()
+                with torch.inference_mode():
+                    outputs = self.phi2_model(input_ids=input_ids, use_cache=True)
+                
+                past_key_values = outputs.past_key_values
+                if not isinstance(past_key_values, tuple):
+                    raise TypeError(f"unsupported past_key_values type {type(past_key_values).__name__}")
+                
+                cached = self._system_prefix_cache[prompt_type] = (input_ids, past_key_values)
+                
+            except Exception as e:
+                # Модель не поддерживает готовый KV-кэш - работаем без него
+                logger.error(f"System prompt KV cache disabled: {e}")
+                self._prefix_cache_enabled = False
+                return None
+        
+        prefix_ids, past_key_values = cached
+        with torch.inference_mode():
+            past_key_values = tuple(tuple(tensor.clone() for tensor in layer) for layer in past_key_values)
+        return prefix_ids, past_key_values
+    
+    async def _build_prompt(self, command: str, context: Dict[str, Any], 
+                           prompt_type: str = "assistant") -> str:
+        """Создание промпта в пуле токенизации (json.dumps большого контекста блокирует loop)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._tok_pool, self._create_prompt, command, context, prompt_type)
+    
     def _create_prompt(self, command: str, context: Dict[str, Any], 
                       prompt_type: str = "assistant") -> str:
         """Создание промпта для модели"""
@@ -372,16 +690,7 @@ class BrainProcessor:
     
     def _extract_code_blocks(self, text: str) -> List[str]:
         """Извлечение блоков кода из текста"""
-        code_blocks = []
-        
-        # Поиск блоков кода в markdown формате
-        pattern = r'```(?:python|py|javascript|js|html|css|json|sql)?\n(.*?)\n```'
-        matches = re.findall(pattern, text, re.DOTALL)
-        
-        for match in matches:
-            code_blocks.append(match.strip())
-        
-        return code_blocks
+        return [match.strip() for match in _CODE_BLOCK_RE.findall(text)]
     
     def _parse_task_plan(self, plan_text: str) -> List[Dict[str, Any]]:
         """Парсинг плана выполнения задач"""
@@ -419,22 +728,46 @@ class BrainProcessor:
             raise RuntimeError("Embedding model not loaded")
         
         try:
-            # Проверка кэша
-            cache_key = hash(tuple(texts))
-            if cache_key in self._embedding_cache:
-                return self._embedding_cache[cache_key]
-            
-            # Генерация эмбеддингов
-            loop = asyncio.get_event_loop()
-            embeddings = await loop.run_in_executor(
-                None,
-                lambda: self.embedding_model.encode(texts)
-            )
+            keys = [hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest() for text in texts]
+            
+            # Проверка кэша: найденные векторы и тексты, которые нужно посчитать
+            vectors: Dict[bytes, np.ndarray] = {}
+            missing: Dict[bytes, str] = {}
+            for key, text in zip(keys, texts):
+                if key in vectors or key in missing:
+                    continue
+                cached = self._embedding_cache.get(key)
+                if cached is not None:
+                    self._embedding_cache.move_to_end(key)
+                    vectors[key] = cached
+                else:
+                    missing[key] = text
+            
+            if missing:
+                # Генерация эмбеддингов только для отсутствующих текстов
+                loop = asyncio.get_event_loop()
+                embeddings = await loop.run_in_executor(
+                    None,
+                    lambda: self.embedding_model.encode(
+                        list(missing.values()),
+                        batch_size=EMBEDDING_BATCH_SIZE,
+                        convert_to_numpy=True,
+                        normalize_embeddings=True,
+                        show_progress_bar=False
+                    )
+                )
+                
+                # Сохранение в кэш с вытеснением самых старых
+                for key, vector in zip(missing, embeddings.astype(np.float16)):
+                    vectors[key] = self._embedding_cache[key] = vector
+                while len(self._embedding_cache) > EMBEDDING_CACHE_SIZE:
+                    self._embedding_cache.popitem(last=False)
             
-            # Сохранение в кэш
-            self._embedding_cache[cache_key] = embeddings
+            if not keys:
+                return np.empty((0, 0), dtype=np.float32)
             
-            return embeddings
+            # Сборка результата в исходном порядке
+            return np.stack([vectors[key] for key in keys]).astype(np.float32)
             
         except Exception as e:
             logger.error(f"Failed to get embeddings: {e}")
@@ -461,6 +794,20 @@ class BrainProcessor:
     async def cleanup(self):
         """Очистка ресурсов"""
         try:
+            # Остановка микробатчинга генерации
+            if self._batch_task:
+                self._batch_task.cancel()
+                try:
+                    await self._batch_task
+                except asyncio.CancelledError:
+                    pass
+                self._batch_task = None
+            self._gen_queue = None
+            
+            if self._gen_pool:
+                self._gen_pool.shutdown(wait=True)
+                self._gen_pool = None
+            
             # Очистка моделей
             if self.phi2_model:
                 del self.phi2_model
@@ -480,6 +827,7 @@ class BrainProcessor:
             
             # Очистка кэша
             self._embedding_cache.clear()
+            self._system_prefix_cache.clear()
             
             # Очистка GPU памяти
             if torch.cuda.is_available():
@@ -497,6 +845,8 @@ class BrainProcessor:
             "embedding_model": self.config.embedding_model,
             "device": self.device,
             "phi2_loaded": self.phi2_model is not None,
+            "phi2_compiled": self.phi2_compiled,
+            "phi2_quantization": self.config.quantization if self.phi2_quantized else "none",
             "embedding_loaded": self.embedding_model is not None,
             "classification_loaded": self.classification_pipeline is not None,
             "max_tokens": self.config.max_tokens,
@@ -28,6 +28,8 @@ class ModelConfig:
     device: str = "cpu"
     max_tokens: int = 2048
     temperature: float = 0.7
+    # Квантизация Phi-2: "none" или "int4" (NF4, нужны CUDA и bitsandbytes)
+    quantization: str = "none"
 
 @dataclass
 class ServiceConfig:
@@ -39,7 +41,7 @@ class ServiceConfig:
     log_level: str = "INFO"
     debug: bool = False
 
-@dataclass
+@dataclass(slots=True)
 class SecurityConfig:
     """Конфигурация безопасности"""
     secret_key: str
@@ -118,7 +120,8 @@ class ConfigManager:
                 "embedding_model": os.getenv("EMBEDDING_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"),
                 "device": os.getenv("MODEL_DEVICE", "cpu"),
                 "max_tokens": int(os.getenv("MODEL_MAX_TOKENS", "2048")),
-                "temperature": float(os.getenv("MODEL_TEMPERATURE", "0.7"))
+                "temperature": float(os.getenv("MODEL_TEMPERATURE", "0.7")),
+                "quantization": os.getenv("MODEL_QUANTIZATION", "none")
             },
             "service": {
                 "name": os.getenv("SERVICE_NAME", "jarvis"),
@@ -44,8 +44,16 @@ class JarvisLogger:
         file_handler.setFormatter(formatter)
         self.logger.addHandler(file_handler)
     
+    def isEnabledFor(self, level: int) -> bool:
+        """Проверка, будет ли записано сообщение данного уровня"""
+        return self.logger.isEnabledFor(level)
+    
     def _log_with_context(self, level: str, message: str, context: Optional[Dict[str, Any]] = None):
         """Логирование с контекстом"""
+        # Отключенные уровни не сериализуются
+        if not self.logger.isEnabledFor(logging.getLevelName(level)):
+            return
+        
         log_data = {
             "service": self.service_name,
             "level": level,